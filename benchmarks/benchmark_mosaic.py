@@ -0,0 +1,76 @@
+"""
+Benchmark of the parallel tile compositing on synthetic multi-section rasters.
+
+    python benchmarks/benchmark_mosaic.py --sections 6 --size 4000 --workers 1 2 4 8
+"""
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+# pylint: disable=wrong-import-position
+from utils.mosaic import mosaic_parallel
+
+
+def write_synthetic_sections(outdir: Path, n_sections: int, size: int) -> list:
+    """
+    Writes n_sections overlapping 4 band uint16 rasters in a row, each size x size
+    pixels with an overlap of a quarter section.
+    """
+    rng = np.random.default_rng(42)
+    section_paths = []
+    for i in range(n_sections):
+        path = outdir / f"section_{i}.tif"
+        profile = {
+            "driver": "GTiff",
+            "dtype": "uint16",
+            "count": 4,
+            "width": size,
+            "height": size,
+            "crs": "EPSG:32631",
+            "transform": from_origin(500000 + i * size * 1.5, 5000000, 2, 2),
+            "nodata": 0,
+            "tiled": True,
+            "blockxsize": 256,
+            "blockysize": 256,
+        }
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(rng.integers(1, 4096, (4, size, size), dtype="uint16"))
+        section_paths.append(path)
+    return section_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sections", type=int, default=6)
+    parser.add_argument("--size", type=int, default=4000)
+    parser.add_argument("--tile-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        section_paths = write_synthetic_sections(Path(tmpdir), args.sections, args.size)
+        baseline = None
+        for n_workers in args.workers:
+            start = time.perf_counter()
+            mosaic_parallel(
+                section_paths,
+                Path(tmpdir) / f"mosaic_{n_workers}.tif",
+                n_workers=n_workers,
+                tile_size=args.tile_size,
+            )
+            duration = time.perf_counter() - start
+            baseline = baseline or duration
+            print(
+                f"workers={n_workers:<3} {duration:8.2f} s  speedup {baseline / duration:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
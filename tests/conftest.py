@@ -0,0 +1,57 @@
+import pytest
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+import geopandas as gpd
+
+
+def write_section(path, left, top, width, height, value, res=2.0, crs="EPSG:32631"):
+    """
+    Writes a synthetic 4 band uint16 section raster with constant pixel values.
+    """
+    profile = {
+        "driver": "GTiff",
+        "dtype": "uint16",
+        "count": 4,
+        "width": width,
+        "height": height,
+        "crs": crs,
+        "transform": from_origin(left, top, res, res),
+        "nodata": 0,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.full((4, height, width), value, dtype="uint16"))
+    return path
+
+
+@pytest.fixture
+def section_paths(tmp_path):
+    """
+    Three overlapping sections, the mosaic is 500 x 400 pixels.
+    """
+    sections_dir = tmp_path / "sections"
+    sections_dir.mkdir()
+    return [
+        write_section(sections_dir / "a.tif", 500000, 5000000, 300, 300, 1),
+        write_section(sections_dir / "b.tif", 500400, 4999800, 300, 300, 2),
+        write_section(sections_dir / "c.tif", 500100, 4999500, 200, 150, 3),
+    ]
+
+
+@pytest.fixture
+def sections(section_paths):
+    """
+    Optimized sections (in priority order b, a, c) of the section rasters in
+    EPSG:4326. The section of a ends at x=500450, before its raster does.
+    """
+    return gpd.GeoDataFrame(
+        {"scene_id": ["b", "a", "c"]},
+        geometry=[
+            box(500350, 4999200, 501000, 4999800),
+            box(500000, 4999400, 500450, 5000000),
+            box(500100, 4999200, 500500, 4999500),
+        ],
+        crs="EPSG:32631",
+    ).to_crs(epsg=4326)
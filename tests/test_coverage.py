@@ -0,0 +1,47 @@
+import pytest
+import rasterio
+from rasterio.windows import Window
+from shapely.geometry import box
+import geopandas as gpd
+
+from utils.coverage import read_valid_footprint, verify_coverage
+
+
+@pytest.fixture
+def aoi():
+    return gpd.GeoDataFrame(
+        geometry=[box(500000, 4999200, 501000, 5000000)], crs="EPSG:32631"
+    ).to_crs(epsg=4326)
+
+
+def test_read_valid_footprint(section_paths):
+    footprint = gpd.GeoSeries([read_valid_footprint(section_paths[0])], crs=4326)
+    assert footprint.to_crs(epsg=32631).total_bounds == pytest.approx(
+        [500000, 4999400, 500600, 5000000], abs=0.01
+    )
+
+    # A decimated read is accurate to about one decimated pixel (8 m).
+    footprint = gpd.GeoSeries(
+        [read_valid_footprint(section_paths[0], max_size=75)], crs=4326
+    )
+    assert footprint.to_crs(epsg=32631).area[0] == pytest.approx(600 * 600, rel=0.01)
+
+
+def test_read_valid_footprint_nodata(section_paths):
+    with rasterio.open(section_paths[0], "r+") as dst:
+        dst.write(
+            dst.read(window=Window(0, 0, 300, 100)) * 0, window=Window(0, 0, 300, 100)
+        )
+    footprint = gpd.GeoSeries([read_valid_footprint(section_paths[0])], crs=4326)
+    assert footprint.to_crs(epsg=32631).total_bounds == pytest.approx(
+        [500000, 4999400, 500600, 4999800], abs=0.01
+    )
+
+
+def test_verify_coverage(section_paths, aoi):
+    cov, gaps, footprints = verify_coverage(aoi, section_paths, n_workers=1)
+    assert cov == pytest.approx(87.5, abs=0.01)
+    assert len(gaps) == 2
+    assert gaps.area_sqkm.sum() == pytest.approx(0.1, abs=0.001)
+    assert footprints.path.tolist() == [str(path) for path in section_paths]
+    assert footprints.crs.to_epsg() == 4326
@@ -4,6 +4,7 @@ from pathlib import Path
 # pylint: disable=wildcard-import, unused-wildcard-import
 from utils.geo import *
 
+import numpy as np
 from shapely.geometry import shape
 
 # pylint: disable=redefined-outer-name
@@ -208,3 +209,123 @@ def test_coverage_percentage(df_multipolygon):
     assert cov >= 100
     cov = coverage_percentage(df_multipolygon.loc[[0]].buffer(10), df_multipolygon)
     assert cov < 100
+
+
+def test_clip_to_aoi():
+    df = gpd.GeoDataFrame(
+        {"scene_id": ["contains", "within", "partial", "outside", "touches"]},
+        geometry=[
+            box(-1, -1, 3, 3),
+            box(0.5, 0.5, 1, 1),
+            box(1, 1, 3, 3),
+            box(5, 5, 6, 6),
+            box(2, 0, 3, 1),
+        ],
+        crs="EPSG:4326",
+    )
+    aoi = box(0, 0, 2, 2)
+    clipped = clip_to_aoi(df, aoi)
+    assert clipped.scene_id.tolist() == ["contains", "within", "partial"]
+    assert clipped.geometry.iloc[0].equals(aoi)
+    assert clipped.geometry.iloc[1].equals(df.geometry.iloc[1])
+    assert clipped.geometry.iloc[2].area == pytest.approx(1)
+
+
+def test_get_best_sections_per_feature():
+    df = gpd.GeoDataFrame.from_file(
+        Path(__file__).parent
+        / Path("./mock_data/search_results_limited_columns.geojson")
+    )
+    bounds = df.geometry.iloc[0].bounds
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            box(bounds[0], bounds[1], bounds[0] + 0.05, bounds[1] + 0.05),
+            box(bounds[2] - 0.05, bounds[3] - 0.05, bounds[2], bounds[3]),
+            box(0, 0, 0.1, 0.1),
+        ],
+        crs="EPSG:4326",
+    )
+    out_df = get_best_sections_per_feature(df, aoi, n_workers=1)
+    assert set(out_df.aoi_feature) == {0, 1}
+    for i in [0, 1]:
+        cov = coverage_percentage(aoi.loc[[i]], out_df[out_df.aoi_feature == i])
+        assert cov == pytest.approx(100, abs=1)
+
+
+def test_get_best_sections_per_feature_small_feature():
+    df = gpd.GeoDataFrame.from_file(
+        Path(__file__).parent
+        / Path("./mock_data/search_results_limited_columns.geojson")
+    )
+    bounds = df.geometry.iloc[0].bounds
+    # The second feature is about 0.1 sqkm, smaller than min_size_section_sqkm.
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            box(bounds[0], bounds[1], bounds[0] + 0.05, bounds[1] + 0.05),
+            box(
+                bounds[0] + 0.02, bounds[1] + 0.02, bounds[0] + 0.023, bounds[1] + 0.023
+            ),
+        ],
+        crs="EPSG:4326",
+    )
+    out_df = get_best_sections_per_feature(df, aoi, n_workers=1)
+    assert set(out_df.aoi_feature) == {0}
+
+    with pytest.raises(NoDataError):
+        get_best_sections_per_feature(df, aoi.iloc[[1]], n_workers=1)
+
+
+def test_weighted_score():
+    df = gpd.GeoDataFrame(
+        {
+            "cloudCoverage": [0.0, 50.0, 0.0],
+            "incidenceAngle": [10.0, 10.0, np.nan],
+            "acquisitionDate": pd.to_datetime(
+                ["2020-01-01", "2020-01-01", "2019-01-01"], utc=True
+            ),
+        },
+        geometry=[box(0, 0, 1, 1)] * 3,
+    )
+    area_sqkm = np.array([10.0, 10.0, 10.0])
+    score = WeightedScore()
+    score.fit(df, area_sqkm)
+    scores = score(df, area_sqkm)
+    # Clouds and the missing incidence angle (scores worst) lower the score.
+    assert scores[0] > scores[1]
+    assert scores[0] > scores[2]
+    assert scores[0] == pytest.approx(1.0 + 0.5 * 0.8 + 0.25 + 1.0)
+    # Less remaining area lowers the score.
+    assert score(df.iloc[[0]], np.array([5.0]))[0] == pytest.approx(scores[0] - 0.5)
+
+    # Credits are only used if weighted explicitly.
+    df["creditsPerSqkm"] = [5.0, 10.0, 2.5]
+    score.fit(df, area_sqkm)
+    np.testing.assert_array_equal(score(df, area_sqkm), scores)
+    df = df.drop(columns="creditsPerSqkm")
+
+    score = WeightedScore(weights={"credits": 1.0}, credits_per_sqkm={"a": 10.0})
+    df["constellation"] = ["a", "a", "b"]
+    score.fit(df, area_sqkm)
+    assert score(df, area_sqkm).tolist() == [0, 0, 0]
+    df["creditsPerSqkm"] = [5.0, 10.0, 2.5]
+    score.fit(df, area_sqkm)
+    assert score(df, area_sqkm).tolist() == [0.5, 0, 0.75]
+
+    with pytest.raises(ValueError):
+        WeightedScore(weights={"price": 1.0})
+
+
+def test_get_best_sections_full_coverage_score():
+    df = gpd.GeoDataFrame.from_file(
+        Path(__file__).parent
+        / Path("./mock_data/search_results_limited_columns.geojson")
+    )
+    aoi = gpd.GeoDataFrame(geometry=[df.unary_union], crs="EPSG:4326")
+    out_df = get_best_sections_full_coverage(df, score=WeightedScore())
+    assert coverage_percentage(aoi, out_df) == pytest.approx(100, abs=0.1)
+    assert (out_df.full_coverage > 0.5).all()
+    # The sections don't overlap.
+    utm_df = out_df.to_crs(epsg=32638)
+    assert utm_df.area.sum() == pytest.approx(utm_df.unary_union.area, rel=1e-6)
+    # Scores only decrease, as the remaining areas shrink with each selection.
+    assert out_df.score.is_monotonic_decreasing
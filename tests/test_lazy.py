@@ -0,0 +1,58 @@
+import sys
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from utils.lazy import lazy_import
+
+HEAVY_MODULES = [
+    "up42",
+    "rasterio",
+    "matplotlib",
+    "ipyfilechooser",
+    "ipywidgets",
+    "IPython",
+    "geopandas",
+    "pandas",
+    "pyproj",
+]
+
+
+def cold_import(module: str) -> dict:
+    """
+    Imports a module in a fresh interpreter, returns the cumulative import time in
+    microseconds of every module that was loaded.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(__file__).resolve().parents[1],
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+@pytest.mark.parametrize(
+    "module, budget_seconds", [("utils.geo", 0.5), ("utils.widgets", 1.0)]
+)
+def test_cold_import(module, budget_seconds):
+    import_times = cold_import(module)
+    assert not [
+        name for name in import_times if name.split(".")[0] in HEAVY_MODULES
+    ], "Heavy dependencies must be imported lazily!"
+    assert import_times[module] / 10 ** 6 < budget_seconds
+
+
+def test_lazy_import():
+    json = lazy_import("json")
+    assert json.dumps([1]) == "[1]"
+    with pytest.raises(ModuleNotFoundError):
+        lazy_import("not_a_module")
@@ -0,0 +1,533 @@
+import time
+
+import pytest
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.windows import Window
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_bounds
+from rasterio.merge import merge
+from rasterio.enums import Resampling
+from shapely.geometry import box, LineString, MultiLineString
+
+from conftest import write_section
+
+from utils.mosaic import (
+    get_mosaic_profile,
+    get_tile_windows,
+    get_section_bounds,
+    get_tile_sections,
+    composite_tile,
+    composite_tile_cutlines,
+    distance_to_lines,
+    get_overview_factors,
+    get_changed_footprints,
+    update_mosaic,
+    update_or_create_mosaic,
+    IncrementalUpdateError,
+    get_target_grid,
+    match_section_files,
+    mosaic_parallel,
+    build_vrt,
+    materialize_vrt,
+    write_cog,
+    mosaic_cog,
+    check_cog_codec,
+    validate_cog,
+    read_preview,
+    MOSAIC_COLORINTERP,
+)
+
+
+def test_get_mosaic_profile(section_paths):
+    profile = get_mosaic_profile(section_paths)
+    assert profile["width"] == 500
+    assert profile["height"] == 400
+    assert profile["tiled"]
+    assert profile["transform"].c == 500000
+    assert profile["transform"].f == 5000000
+
+
+def test_get_tile_windows():
+    tile_windows = get_tile_windows(500, 400, 256)
+    assert len(tile_windows) == 4
+    assert tile_windows[1].col_off == 256
+    assert tile_windows[1].width == 244
+    assert tile_windows[3].height == 144
+    assert sum(w.width * w.height for w in tile_windows) == 500 * 400
+
+
+def test_composite_tile(section_paths):
+    profile = get_mosaic_profile(section_paths)
+    tile_windows = get_tile_windows(500, 400, 256)
+    footprints = [box(*bounds) for bounds in get_section_bounds(section_paths)]
+    tile_sections = get_tile_sections(tile_windows, footprints, profile["transform"])
+    assert tile_sections[0] == [0, 1, 2]
+    assert tile_sections[1] == [0, 1]
+    tile_sections = [
+        [(section_paths[i], footprints[i]) for i in idx] for idx in tile_sections
+    ]
+
+    tile = composite_tile(tile_windows[0], tile_sections[0], profile)
+    assert tile.shape == (4, 256, 256)
+    assert tile[0, 0, 0] == 1
+
+    tile = composite_tile(tile_windows[2], [], profile)
+    assert tile.shape == (4, 144, 256)
+    assert not tile.any()
+
+
+def test_mosaic_parallel(section_paths, tmp_path):
+    expected, _ = merge([str(fp) for fp in section_paths])
+
+    for n_workers in [1, 2]:
+        out_path = mosaic_parallel(
+            section_paths, tmp_path / f"mosaic_{n_workers}.tif", n_workers, 256
+        )
+        with rasterio.open(out_path) as src:
+            assert src.block_shapes[0] == (256, 256)
+            assert src.colorinterp[0] == rasterio.enums.ColorInterp.red
+            np.testing.assert_array_equal(src.read(), expected)
+
+
+def test_build_vrt(section_paths, tmp_path):
+    expected, _ = merge([str(fp) for fp in section_paths])
+
+    (tmp_path / "mosaic").mkdir()
+    vrt_path = build_vrt(section_paths, tmp_path / "mosaic" / "mosaic.vrt")
+    assert "../sections/a.tif" in vrt_path.read_text()
+    with rasterio.open(vrt_path) as src:
+        assert list(src.colorinterp) == MOSAIC_COLORINTERP
+        np.testing.assert_array_equal(src.read(), expected)
+
+    # Would be resampled onto the grid of the first section.
+    fine_path = write_section(
+        tmp_path / "fine.tif", 500000, 5000000, 100, 100, 4, res=1.0
+    )
+    with pytest.raises(ValueError):
+        build_vrt([*section_paths, fine_path], tmp_path / "mosaic" / "mixed.vrt")
+
+
+def test_materialize_vrt(section_paths, tmp_path):
+    expected, _ = merge([str(fp) for fp in section_paths])
+    vrt_path = build_vrt(section_paths, tmp_path / "mosaic.vrt")
+
+    out_path = materialize_vrt(vrt_path, tmp_path / "mosaic.tif", tile_size=256)
+    with rasterio.open(out_path) as src:
+        assert src.driver == "GTiff"
+        assert list(src.colorinterp) == MOSAIC_COLORINTERP
+        np.testing.assert_array_equal(src.read(), expected)
+
+    bounds = (500100, 4999300, 500700, 4999900)
+    out_path = materialize_vrt(vrt_path, tmp_path / "window.tif", bounds=bounds)
+    with rasterio.open(out_path) as src:
+        assert src.shape == (300, 300)
+        assert tuple(src.bounds) == bounds
+        np.testing.assert_array_equal(src.read(), expected[:, 50:350, 50:350])
+
+
+@pytest.mark.parametrize("codec", ["DEFLATE", "ZSTD", "LZW"])
+def test_write_cog(section_paths, tmp_path, codec):
+    expected, _ = merge([str(fp) for fp in section_paths])
+    mosaic_path = mosaic_parallel(section_paths, tmp_path / "mosaic.tif", 1)
+    assert validate_cog(mosaic_path)
+
+    stats = write_cog(mosaic_path, tmp_path / "cog.tif", codec=codec)
+    assert stats["codec"] == codec
+    assert stats["size_mb"] < mosaic_path.stat().st_size / 10 ** 6
+    assert stats["throughput_mb_s"] > 0
+    assert not validate_cog(stats["path"])
+    with rasterio.open(stats["path"]) as src:
+        assert src.compression.name.upper() == codec
+        assert src.overviews(1)
+        assert list(src.colorinterp) == MOSAIC_COLORINTERP
+        np.testing.assert_array_equal(src.read(), expected)
+
+
+def test_write_cog_lossy_requires_8bit_rgb(section_paths, tmp_path):
+    vrt_path = build_vrt(section_paths, tmp_path / "mosaic.vrt")
+    with pytest.raises(ValueError):
+        write_cog(vrt_path, tmp_path / "cog.tif", codec="JPEG")
+    with pytest.raises(ValueError):
+        write_cog(vrt_path, tmp_path / "cog.tif", codec="PNG")
+    assert not (tmp_path / "cog.tif").exists()
+
+
+def test_check_cog_codec():
+    assert check_cog_codec("zstd", 4, "uint16") == "ZSTD"
+    assert check_cog_codec("JPEG", 3, "uint8") == "JPEG"
+    assert check_cog_codec("WEBP", 4, "uint8", alpha=True) == "WEBP"
+    for codec, count, dtype in [
+        ("JPEG", 4, "uint16"),
+        ("JPEG", 4, "uint8"),
+        # The 4th band is e.g. NIR, not alpha.
+        ("WEBP", 4, "uint8"),
+        ("WEBP", 2, "uint8"),
+        ("PNG", 3, "uint8"),
+    ]:
+        with pytest.raises(ValueError):
+            check_cog_codec(codec, count, dtype)
+
+
+def test_write_cog_invalid(section_paths, tmp_path, monkeypatch):
+    mosaic_path = mosaic_parallel(section_paths, tmp_path / "mosaic.tif", 1)
+    monkeypatch.setattr(
+        "utils.mosaic.validate_cog", lambda path: ["File was edited after creation."]
+    )
+    with pytest.raises(ValueError):
+        write_cog(mosaic_path, tmp_path / "cog.tif")
+    assert not (tmp_path / "cog.tif").exists()
+
+
+def test_mosaic_cog(section_paths, tmp_path):
+    out_dir = tmp_path / "mosaic"
+    out_dir.mkdir()
+    # The codec is checked before compositing.
+    with pytest.raises(ValueError):
+        mosaic_cog(section_paths, out_dir / "mosaic.tif", "JPEG", n_workers=1)
+    assert not list(out_dir.iterdir())
+
+    stats = mosaic_cog(section_paths, out_dir / "mosaic.tif", "ZSTD", n_workers=1)
+    assert stats["updated_tiles"] is None
+    assert not validate_cog(stats["path"])
+    # The working copy is kept for incremental updates.
+    assert sorted(path.name for path in out_dir.iterdir()) == [
+        "mosaic.tif",
+        "mosaic_working.json",
+        "mosaic_working.tif",
+    ]
+
+    # Nothing changed, the COG is not rewritten.
+    mtime = stats["path"].stat().st_mtime_ns
+    stats = mosaic_cog(section_paths, out_dir / "mosaic.tif", "ZSTD", n_workers=1)
+    assert stats["updated_tiles"] == 0
+    assert not stats["rewritten"]
+    assert stats["path"].stat().st_mtime_ns == mtime
+    # Unless the codec changed.
+    stats = mosaic_cog(section_paths, out_dir / "mosaic.tif", "DEFLATE", n_workers=1)
+    assert stats["updated_tiles"] == 0
+    assert stats["rewritten"]
+    with rasterio.open(stats["path"]) as src:
+        assert src.compression.name.upper() == "DEFLATE"
+
+    write_section(section_paths[2], 500100, 4999500, 200, 150, 5)
+    stats = mosaic_cog(section_paths, out_dir / "mosaic.tif", "ZSTD", n_workers=1)
+    assert stats["updated_tiles"] == 1
+    assert stats["rewritten"]
+    assert not validate_cog(stats["path"])
+    expected, _ = merge([str(fp) for fp in section_paths])
+    with rasterio.open(stats["path"]) as src:
+        np.testing.assert_array_equal(src.read(), expected)
+    with rasterio.open(stats["path"], overview_level=0) as src:
+        overview = src.read()
+    expected_path = mosaic_parallel(
+        section_paths, tmp_path / "expected.tif", 1, overviews=True
+    )
+    with rasterio.open(expected_path, overview_level=0) as src:
+        np.testing.assert_array_equal(overview, src.read())
+
+
+def test_mosaic_parallel_compress(section_paths, tmp_path):
+    expected, _ = merge([str(fp) for fp in section_paths])
+    uncompressed_path = mosaic_parallel(section_paths, tmp_path / "mosaic.tif", 1)
+    mosaic_path = mosaic_parallel(
+        section_paths, tmp_path / "compressed.tif", 1, compress="DEFLATE"
+    )
+    assert mosaic_path.stat().st_size < uncompressed_path.stat().st_size
+    with rasterio.open(mosaic_path) as src:
+        assert src.compression.name.upper() == "DEFLATE"
+        np.testing.assert_array_equal(src.read(), expected)
+
+
+def test_read_preview(section_paths, tmp_path):
+    mosaic_path = mosaic_parallel(section_paths, tmp_path / "mosaic.tif", 1)
+    stats = write_cog(mosaic_path, tmp_path / "cog.tif")
+
+    for path in [mosaic_path, stats["path"]]:
+        preview, extent = read_preview(path, max_size=100)
+        assert preview.shape == (80, 100, 4)
+        assert extent == (500000, 501000, 4999200, 5000000)
+        assert preview.min() >= 0
+        assert preview.max() <= 1
+        # Top right corner of the mosaic is not covered by any section.
+        assert preview[0, -1, 3] == 0
+        assert preview[0, 0, 3] == 1
+
+    preview, _ = read_preview(mosaic_path, max_size=1000)
+    assert preview.shape == (400, 500, 4)
+
+
+def test_match_section_files(section_paths, sections):
+    matched, unmatched_paths, unmatched_sections = match_section_files(
+        sections, list(reversed(section_paths))
+    )
+    assert matched["scene_id"].tolist() == ["b", "a", "c"]
+    assert [path.name for path in matched["path"]] == ["b.tif", "a.tif", "c.tif"]
+    assert not unmatched_paths
+    assert unmatched_sections.empty
+
+    # A raster without a section.
+    matched, unmatched_paths, unmatched_sections = match_section_files(
+        sections.iloc[:2], section_paths
+    )
+    assert [path.name for path in matched["path"]] == ["b.tif", "a.tif"]
+    assert [path.name for path in unmatched_paths] == ["c.tif"]
+    assert unmatched_sections.empty
+
+    # A section without a raster.
+    matched, unmatched_paths, unmatched_sections = match_section_files(
+        sections, section_paths[::2]
+    )
+    assert matched["scene_id"].tolist() == ["a", "c"]
+    assert not unmatched_paths
+    assert unmatched_sections["scene_id"].tolist() == ["b"]
+
+
+def test_composite_tile_cutlines(section_paths, sections):
+    profile = get_mosaic_profile(section_paths)
+    cutlines = list(sections.to_crs(epsg=32631).geometry)
+    tile = composite_tile_cutlines(
+        Window(0, 0, 500, 400),
+        [(section_paths[1], cutlines[0]), (section_paths[0], cutlines[1])],
+        profile,
+    )
+    assert tile.shape == (4, 400, 500)
+    # Overlap of a and b, b comes first.
+    assert (tile[:, 150, 200] == 2).all()
+    # Only a, but b cutline starts at x=500350.
+    assert (tile[:, 150, 150] == 1).all()
+    # Within a raster, but outside its cutline.
+    assert (tile[:, 50, 260] == 0).all()
+
+
+def test_mosaic_parallel_cutlines(section_paths, sections, tmp_path):
+    matched, _, _ = match_section_files(sections, section_paths)
+    out_path = mosaic_parallel(
+        matched["path"].tolist(),
+        tmp_path / "mosaic.tif",
+        n_workers=2,
+        tile_size=256,
+        cutlines=matched.geometry,
+    )
+    with rasterio.open(out_path) as src:
+        assert tuple(src.bounds) == (500000, 4999200, 501000, 5000000)
+        mosaic = src.read(1)
+    assert mosaic[150, 200] == 2
+    assert mosaic[150, 150] == 1
+    assert mosaic[50, 260] == 0
+    # Overlap of a and c, a comes first.
+    assert mosaic[270, 100] == 1
+    assert mosaic[320, 100] == 3
+
+
+def test_distance_to_lines():
+    xs = np.array([0.0, 5.0, 15.0])
+    ys = np.array([1.0, -2.0, 0.0])
+    distance = distance_to_lines(xs, ys, LineString([(0, 0), (10, 0)]))
+    np.testing.assert_allclose(distance, [1, 2, 5])
+    assert np.isinf(distance_to_lines(xs, ys, box(0, 0, 1, 1))).all()
+    # Computed in chunks of point-segment pairs.
+    lines = MultiLineString([[(0, 0), (10, 0)], [(0, 5), (5, 10), (10, 5)]])
+    np.testing.assert_allclose(
+        distance_to_lines(xs, ys, lines, chunk_size=2),
+        distance_to_lines(xs, ys, lines),
+    )
+
+
+def test_composite_tile_cutlines_feather(tmp_path):
+    section_paths = [
+        write_section(tmp_path / "a.tif", 500000, 5000000, 100, 10, 100),
+        write_section(tmp_path / "b.tif", 500100, 5000000, 100, 10, 200),
+    ]
+    # Overlap strip from x=500140 to 500160 (10 pixels).
+    cutlines = [
+        box(500000, 4999980, 500160, 5000000),
+        box(500140, 4999980, 500400, 5000000),
+    ]
+    profile = get_mosaic_profile(section_paths)
+    window = Window(0, 0, profile["width"], profile["height"])
+    tile_sections = list(zip(section_paths, cutlines))
+
+    hard = composite_tile_cutlines(window, tile_sections, profile)
+    feathered = composite_tile_cutlines(window, tile_sections, profile, feather=True)
+    np.testing.assert_array_equal(hard[:, :, :70], feathered[:, :, :70])
+    np.testing.assert_array_equal(hard[:, :, 80:], feathered[:, :, 80:])
+    assert (hard[0, :, 70:80] == 100).all()
+
+    ramp = feathered[0, 0, 70:80]
+    assert (np.diff(ramp.astype(int)) > 0).all()
+    assert ramp[0] == 105
+    assert ramp[-1] == 195
+    assert (feathered[0] == feathered[0, 0]).all()
+
+
+def test_composite_tile_cutlines_feather_many_vertices(tmp_path):
+    section_paths = [
+        write_section(tmp_path / "a.tif", 500000, 5000000, 512, 512, 100),
+        write_section(tmp_path / "b.tif", 500000, 5000000, 512, 512, 200),
+    ]
+    # Wiggly diagonal seam with round joins, the cutlines have ~500 vertices.
+    t = np.linspace(0, 1, 300)
+    seam = LineString(
+        np.c_[500000 + 1024 * t + 5 * np.sin(t * 200), 5000000 - 1024 * t]
+    )
+    aoi = box(500000, 5000000 - 1024, 500000 + 1024, 5000000)
+    side = seam.buffer(2000, single_sided=True)
+    cutlines = [
+        aoi.intersection(side.buffer(10)),
+        aoi.difference(side).buffer(10).intersection(aoi),
+    ]
+    assert len(cutlines[0].exterior.coords) > 400
+    profile = get_mosaic_profile(section_paths)
+    # A tile the seam enters and leaves.
+    window = Window(100, 100, 256, 256)
+    tile_sections = list(zip(section_paths, cutlines))
+
+    hard = composite_tile_cutlines(window, tile_sections, profile)
+    start = time.perf_counter()
+    feathered = composite_tile_cutlines(window, tile_sections, profile, feather=True)
+    assert time.perf_counter() - start < 5
+
+    strips = cutlines[0].intersection(cutlines[1])
+    in_strips = geometry_mask(
+        [strips],
+        out_shape=(window.height, window.width),
+        transform=windows.transform(window, profile["transform"]),
+        invert=True,
+    )
+    np.testing.assert_array_equal(hard[:, ~in_strips], feathered[:, ~in_strips])
+    blended = feathered[0, in_strips]
+    assert blended.min() < 110 and blended.max() > 190
+    # Measured from the unclipped, unsimplified seam edges, the weights are the same.
+    rows, cols = np.nonzero(in_strips)
+    xs, ys = windows.transform(window, profile["transform"]) * (cols + 0.5, rows + 0.5)
+    distances = [
+        distance_to_lines(
+            np.asarray(xs),
+            np.asarray(ys),
+            cutline.boundary.difference(other.boundary.buffer(0.2)).intersection(other),
+        )
+        for cutline, other in [cutlines, cutlines[::-1]]
+    ]
+    expected = (100 * distances[0] + 200 * distances[1]) / (distances[0] + distances[1])
+    np.testing.assert_allclose(blended, expected, atol=1.5)
+
+
+def test_get_overview_factors():
+    assert get_overview_factors(500, 400) == [2]
+    assert get_overview_factors(256, 100) == []
+    assert get_overview_factors(5000, 3000) == [2, 4, 8, 16, 32]
+
+
+def test_get_changed_footprints():
+    previous = [
+        {"path": p, "checksum": p, "footprint": box(i, 0, i + 1, 1).wkt}
+        for i, p in enumerate(["a", "b", "c"])
+    ]
+    assert not get_changed_footprints(previous, previous)
+
+    current = [dict(previous[0], checksum="new"), previous[1]]
+    changed = get_changed_footprints(previous, current)
+    assert sorted(footprint.bounds[0] for footprint in changed) == [0, 0, 2]
+
+    current = [previous[1], previous[0], previous[2]]
+    changed = get_changed_footprints(previous, current)
+    assert sorted(footprint.bounds[0] for footprint in changed) == [0, 0, 1, 1]
+
+
+def test_update_mosaic(section_paths, tmp_path):
+    mosaic_path = tmp_path / "mosaic.tif"
+    mosaic_parallel(section_paths, mosaic_path, 1, 256, overviews=True)
+    assert mosaic_path.with_suffix(".json").is_file()
+    assert update_mosaic(mosaic_path, section_paths, 1) == 0
+
+    write_section(section_paths[2], 500100, 4999500, 200, 150, 5)
+    assert update_mosaic(mosaic_path, section_paths, 1) == 2
+    assert update_mosaic(mosaic_path, section_paths, 1) == 0
+
+    expected_path = mosaic_parallel(
+        section_paths, tmp_path / "expected.tif", 1, 256, overviews=True
+    )
+    for overview_level in [None, 0]:
+        with rasterio.open(mosaic_path, overview_level=overview_level) as src:
+            mosaic = src.read()
+        with rasterio.open(expected_path, overview_level=overview_level) as src:
+            expected = src.read()
+        assert (mosaic == 5).any()
+        np.testing.assert_array_equal(mosaic, expected)
+
+    with pytest.raises(IncrementalUpdateError):
+        update_mosaic(mosaic_path, section_paths, 1, feather=True)
+    with pytest.raises(IncrementalUpdateError):
+        update_mosaic(mosaic_path, section_paths[1:], 1)
+    with pytest.raises(IncrementalUpdateError):
+        update_mosaic(tmp_path / "missing.tif", section_paths, 1)
+
+
+def test_update_or_create_mosaic(section_paths, tmp_path):
+    mosaic_path = tmp_path / "mosaic.tif"
+    assert update_or_create_mosaic(mosaic_path, section_paths, 1) is None
+    assert update_or_create_mosaic(mosaic_path, section_paths, 1) == 0
+    # Other compositing options can not be updated.
+    assert update_or_create_mosaic(mosaic_path, section_paths[1:], 1) is None
+    with rasterio.open(mosaic_path) as src:
+        assert src.overviews(1)
+
+
+def test_mosaic_parallel_grid(section_paths, tmp_path):
+    # Section b delivered in the neighbouring UTM zone at 4m resolution.
+    bounds_32632 = transform_bounds(
+        "EPSG:32631", "EPSG:32632", 500400, 4999200, 501000, 4999800
+    )
+    b_32632 = write_section(
+        tmp_path / "b_32632.tif",
+        bounds_32632[0],
+        bounds_32632[3],
+        int((bounds_32632[2] - bounds_32632[0]) / 4),
+        int((bounds_32632[3] - bounds_32632[1]) / 4),
+        2,
+        res=4.0,
+        crs="EPSG:32632",
+    )
+    paths = [section_paths[0], b_32632]
+
+    grid = get_target_grid(paths, 32631)
+    assert grid["crs"].to_epsg() == 32631
+    assert grid["res"] == 2
+
+    out_path = mosaic_parallel(paths, tmp_path / "mosaic.tif", 1, 256, grid=grid)
+    with rasterio.open(out_path) as src:
+        assert src.crs.to_epsg() == 32631
+        assert src.res == (2, 2)
+        assert src.transform.c % 2 == 0
+        assert src.transform.f % 2 == 0
+        mosaic = src.read(1)
+        row, col = src.index(500800, 4999400)
+        assert mosaic[row, col] == 2
+        row, col = src.index(500100, 4999900)
+        assert mosaic[row, col] == 1
+
+    with pytest.raises(ValueError):
+        build_vrt(paths, tmp_path / "mosaic.vrt")
+
+
+def test_mosaic_parallel_grid_resampling(tmp_path):
+    # A 4m section with a gradient along the columns, warped onto a 2m grid.
+    path = write_section(tmp_path / "a.tif", 500000, 5000000, 20, 10, 1, res=4.0)
+    with rasterio.open(path, "r+") as dst:
+        dst.write(np.tile(np.arange(10, 210, 10, dtype="uint16"), (4, 10, 1)))
+
+    grid = get_target_grid([path], 32631, res=2)
+    assert grid["resampling"] == Resampling.bilinear
+    bilinear_path = mosaic_parallel([path], tmp_path / "bilinear.tif", 1, grid=grid)
+    grid["resampling"] = Resampling.nearest
+    nearest_path = mosaic_parallel([path], tmp_path / "nearest.tif", 1, grid=grid)
+    with rasterio.open(bilinear_path) as src:
+        bilinear = src.read(1)[5]
+    with rasterio.open(nearest_path) as src:
+        nearest = src.read(1)[5]
+    assert set(np.unique(nearest)) <= set(range(10, 210, 10))
+    # Interpolated between the source pixels.
+    assert len(set(np.unique(bilinear[4:-4])) - set(range(10, 210, 10))) > 0
+    assert np.all(np.diff(bilinear[4:-4].astype(int)) >= 0)
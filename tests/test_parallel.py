@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from utils.parallel import map_bounded
+
+
+def add(a, b):
+    return a + b
+
+
+def test_map_bounded():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = map_bounded(executor, add, range(10), range(10), n_workers=2)
+        assert list(results) == [2 * i for i in range(10)]
+        results = map_bounded(executor, add, range(10), range(10), chunksize=3)
+        assert list(results) == [2 * i for i in range(10)]
+        assert not list(map_bounded(executor, add, [], []))
+
+
+def test_map_bounded_pending():
+    started = []
+    lock = threading.Lock()
+
+    def work(i):
+        with lock:
+            started.append(i)
+        return i
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for i in map_bounded(executor, work, range(100), n_workers=2):
+            # A slow consumer doesn't let the work run ahead of it.
+            with lock:
+                assert len(started) <= i + 1 + 4
@@ -0,0 +1,115 @@
+import sys
+import json
+import subprocess
+
+import numpy as np
+import pytest
+import requests
+from ipywidgets import widgets
+
+from utils.profiling import (
+    record_stage,
+    profiled,
+    format_stage,
+    set_records_path,
+    get_children_pids,
+)
+from utils.widgets import UI
+
+
+@profiled
+def a_hot_path():
+    return sum(range(1000))
+
+
+def test_record_stage(monkeypatch):
+    def send(adapter, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    # Avoids the network below the requests session.
+    monkeypatch.setattr(requests.adapters.HTTPAdapter, "send", send)
+
+    with record_stage("a_stage") as stage:
+        assert a_hot_path() == 499500
+        a_hot_path()
+        requests.get("http://api.test/search")
+    assert requests.Session.send.__name__ == "send"
+
+    assert stage["stage"] == "a_stage"
+    assert (
+        stage["wall_seconds"]
+        >= stage["spans"][f"{__name__}.a_hot_path"]["wall_seconds"]
+    )
+    assert stage["spans"][f"{__name__}.a_hot_path"]["calls"] == 2
+    assert stage["api_calls"] == 1
+    assert stage["peak_rss_mb"] > 0
+    assert stage["error"] is None
+    assert "1 API calls" in format_stage(stage)
+
+
+def test_record_stage_memory():
+    with record_stage("heavy") as heavy:
+        data = np.ones(200 * 2 ** 20, dtype="uint8")
+        with record_stage("nested") as nested:
+            data = np.ones(2 * 200 * 2 ** 20, dtype="uint8")
+        del data
+    with record_stage("light") as light:
+        a_hot_path()
+    # Each stage reports its own peak, not the one of the process lifetime.
+    assert heavy["peak_rss_mb"] - light["peak_rss_mb"] > 300
+    assert nested["peak_rss_mb"] - light["peak_rss_mb"] > 300
+    assert nested["rss_delta_mb"] > 100
+    assert heavy["rss_delta_mb"] < 100
+    assert abs(light["rss_delta_mb"]) < 50
+
+    with record_stage("worker") as worker:
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import time, numpy; a = numpy.ones(100 * 2 ** 20, 'uint8'); "
+                "time.sleep(0.5)",
+            ],
+            check=True,
+        )
+    assert worker["children_peak_rss_mb"] > 100
+    assert light["children_peak_rss_mb"] < 100
+
+
+def test_get_children_pids():
+    with subprocess.Popen([sys.executable, "-c", "import time; time.sleep(1)"]) as p:
+        assert str(p.pid) in get_children_pids()
+        p.kill()
+    assert str(p.pid) not in get_children_pids()
+
+
+def test_record_stage_error():
+    with pytest.raises(ValueError):
+        with record_stage("a_stage") as stage:
+            raise ValueError("failed")
+    assert stage["error"] == "ValueError: failed"
+    assert "wall_seconds" in stage
+
+
+def test_process_template_records(tmp_path, capsys):
+    records_path = tmp_path / "profiling.jsonl"
+    set_records_path(records_path)
+    button = widgets.Button(description="Run!")
+
+    def a_step():
+        a_hot_path()
+
+    try:
+        UI.process_template([], button, a_step)
+        button.click()
+        button.click()
+    finally:
+        set_records_path(None)
+
+    records = [json.loads(line) for line in records_path.read_text().splitlines()]
+    assert [record["stage"] for record in records] == ["a_step", "a_step"]
+    assert records[0]["spans"][f"{__name__}.a_hot_path"]["calls"] == 1
+    capsys.readouterr()
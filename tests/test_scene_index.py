@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+import geopandas as gpd
+from shapely.geometry import box
+
+from utils.scene_index import SceneIndex, SCENE_COLUMNS
+
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def search_results():
+    df = gpd.read_file(
+        Path(__file__).parent / "mock_data/search_results_limited_columns.geojson"
+    )
+    # The catalog returns the same scene for several products.
+    df = df.drop_duplicates("scene_id").reset_index(drop=True)
+    df["acquisitionDate"] = [
+        f"{scene_id[9:13]}-{scene_id[13:15]}-{scene_id[15:17]}T07:50:00"
+        for scene_id in df.scene_id
+    ]
+    return df
+
+
+def test_scene_index(search_results, tmp_path):
+    index = SceneIndex(tmp_path / "scenes")
+    assert index.add_scenes(search_results, sensor="pleiades") == len(search_results)
+    assert index.add_scenes(search_results, sensor="pleiades") == 0
+    index.close()
+
+    # Reopened from disk.
+    index = SceneIndex(tmp_path / "scenes")
+    assert len(index) == len(search_results)
+    aoi = search_results.geometry.iloc[0].centroid.buffer(0.01)
+    scenes = index.query(aoi)
+    assert list(scenes.columns) == [*SCENE_COLUMNS, "geometry"]
+    assert search_results.scene_id.iloc[0] in scenes.scene_id.tolist()
+    assert scenes.intersects(aoi).all()
+    assert len(scenes) == search_results.intersects(aoi).sum()
+
+    assert index.query(box(0, 0, 1, 1)).empty
+    assert index.query(aoi, sensors=["spot"]).empty
+    assert (index.query(aoi, max_incidence_angle=15).incidenceAngle <= 15).all()
+    date = scenes.acquisitionDate.iloc[0]
+    assert (
+        index.query(aoi, start_date=date.date(), end_date=date.date()).acquisitionDate
+        == date
+    ).all()
+    index.close()
+
+
+def test_scene_index_rebuild(search_results, tmp_path):
+    index = SceneIndex(tmp_path / "scenes")
+    index.add_scenes(search_results, sensor="pleiades")
+    index.close()
+    for suffix in [".idx", ".dat"]:
+        (tmp_path / f"scenes{suffix}").unlink()
+
+    index = SceneIndex(tmp_path / "scenes")
+    aoi = search_results.geometry.iloc[0]
+    assert len(index.query(aoi)) == search_results.intersects(aoi).sum()
+    index.close()
+
+
+def test_scene_index_constellation(search_results, tmp_path):
+    search_results["constellation"] = "PHR"
+    index = SceneIndex(tmp_path / "scenes")
+    index.add_scenes(search_results.iloc[:5], sensor="pleiades")
+    # Without the search sensor, it is derived from the constellation.
+    index.add_scenes(search_results.iloc[5:])
+    # Scenes stored with the constellation are found by the sensor.
+    index.connection.execute("UPDATE scenes SET sensor = 'PHR' WHERE rowid = 1")
+    aoi = box(*search_results.total_bounds)
+    assert len(index.query(aoi, sensors=["pleiades"])) == len(search_results)
+    assert index.query(aoi, sensors=["spot"]).empty
+    assert set(index.query(aoi).sensor) == {"pleiades", "PHR"}
+    index.close()
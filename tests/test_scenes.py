@@ -0,0 +1,63 @@
+import pytest
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import box
+
+from utils.scenes import (
+    normalize_search_results,
+    read_raw_properties,
+    write_geojson,
+)
+
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture
+def search_results():
+    n_scenes = 50
+    return gpd.GeoDataFrame(
+        {
+            "id": [f"id-{i}" for i in range(n_scenes)],
+            "scene_id": [f"DS_PHR1A_{i}" for i in range(n_scenes)],
+            "cloudCoverage": np.linspace(0, 20, n_scenes),
+            "acquisitionDate": ["2020-05-02T07:51:07.3Z"] * n_scenes,
+            "constellation": ["PHR"] * n_scenes,
+            "blockNames": [["oneatlas-pleiades-fullscene"]] * n_scenes,
+            "providerProperties": [
+                {"incidenceAngle": float(i), "sunAzimuth": 160.0}
+                for i in range(n_scenes - 1)
+            ]
+            + [{}],
+        },
+        geometry=[box(i, 0, i + 1, 1) for i in range(n_scenes)],
+        crs="EPSG:4326",
+    )
+
+
+def test_normalize_search_results(search_results, tmp_path):
+    raw_path = tmp_path / "properties.jsonl"
+    scenes = normalize_search_results(search_results, raw_path)
+
+    assert scenes.cloudCoverage.dtype == "float32"
+    assert scenes.incidenceAngle.dtype == "float32"
+    assert scenes.incidenceAngle.iloc[1] == 1
+    assert np.isnan(scenes.incidenceAngle.iloc[-1])
+    assert str(scenes.acquisitionDate.dtype) == "datetime64[ns, UTC]"
+    assert scenes.constellation.dtype == "category"
+    assert scenes.blockNames.iloc[0] == "['oneatlas-pleiades-fullscene']"
+    assert "providerProperties" not in scenes
+    assert (
+        scenes.memory_usage(deep=True).sum()
+        < search_results.memory_usage(deep=True).sum()
+    )
+
+    raw = read_raw_properties(raw_path, scenes.raw_offset.iloc[[3, 0]])
+    assert [record["id"] for record in raw] == ["id-3", "id-0"]
+    assert raw[0]["providerProperties"]["sunAzimuth"] == 160
+
+
+def test_write_geojson(search_results, tmp_path):
+    scenes = normalize_search_results(search_results, tmp_path / "properties.jsonl")
+    write_geojson(scenes, tmp_path / "scenes.geojson")
+    df = gpd.read_file(tmp_path / "scenes.geojson")
+    assert len(df) == len(scenes)
+    assert df.constellation.iloc[0] == "PHR"
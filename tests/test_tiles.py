@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+import rasterio
+from rasterio.warp import transform_bounds
+
+from utils.mosaic import mosaic_parallel
+from utils.tiles import (
+    tile_bounds,
+    get_tiles,
+    get_tile_ranges,
+    render_tile,
+    export_tiles,
+    ORIGIN_SHIFT,
+    WEB_MERCATOR,
+)
+
+
+@pytest.fixture()
+def mosaic_path(section_paths, tmp_path):
+    return mosaic_parallel(
+        section_paths, tmp_path / "mosaic.tif", 1, 256, overviews=True
+    )
+
+
+def test_tile_bounds():
+    assert tile_bounds(0, 0, 0) == pytest.approx(
+        (-ORIGIN_SHIFT, -ORIGIN_SHIFT, ORIGIN_SHIFT, ORIGIN_SHIFT)
+    )
+    assert tile_bounds(1, 0, 1) == pytest.approx((0, 0, ORIGIN_SHIFT, ORIGIN_SHIFT))
+
+
+def test_get_tiles():
+    assert get_tiles((-1, -1, 1, 1), [0, 1]) == [
+        (0, 0, 0),
+        (1, 0, 0),
+        (1, 1, 0),
+        (1, 0, 1),
+        (1, 1, 1),
+    ]
+    # Bounds on a tile edge don't include the neighbouring tile.
+    assert get_tiles(tile_bounds(3, 5, 4), [4]) == [(4, 3, 5)]
+
+
+def test_render_tile(mosaic_path):
+    ranges = get_tile_ranges(mosaic_path)
+    assert len(ranges) == 3
+
+    with rasterio.open(mosaic_path) as src:
+        bounds = transform_bounds(src.crs, WEB_MERCATOR, *src.bounds)
+    tile = get_tiles(bounds, [15])[0]
+    data = render_tile(tile, mosaic_path, ranges)
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    assert render_tile((15, 0, 0), mosaic_path, ranges) is None
+
+
+@pytest.mark.parametrize("name", ["tiles", "tiles.mbtiles"])
+def test_export_tiles(mosaic_path, tmp_path, name):
+    out_path = tmp_path / name
+    stats = export_tiles(mosaic_path, out_path, (12, 15), n_workers=1)
+    assert stats["written"] > 0
+    assert stats["existing"] == 0
+
+    if name.endswith(".mbtiles"):
+        with sqlite3.connect(str(out_path)) as connection:
+            n_tiles = connection.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+        assert metadata["minzoom"] == "12"
+    else:
+        n_tiles = len(list(out_path.glob("*/*/*.png")))
+    assert n_tiles == stats["written"]
+
+    resumed = export_tiles(mosaic_path, out_path, (12, 15), n_workers=1)
+    assert resumed["written"] == 0
+    assert resumed["existing"] == stats["written"]
@@ -11,13 +11,17 @@ from utils.widgets import UI
         UI.authenticate,
         UI.load_aoi,
         UI.create_search_params,
+        UI.prescreen_aoi,
         UI.search_available_images,
         UI.show_quicklooks,
         UI.optimize_coverage,
         UI.test_workflow,
         UI.run_workflow,
+        UI.verify_coverage,
         UI.mosaic_sections,
+        UI.materialize_mosaic,
         UI.view_mosaic,
+        UI.export_tiles,
     ],
 )
 def test_ui(ui_method, capsys):
@@ -0,0 +1,110 @@
+from typing import List, Union, Optional, Tuple
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio.features import shapes
+from rasterio.warp import transform_geom
+from rasterio.enums import Resampling
+from affine import Affine
+from shapely.geometry import shape, Polygon, MultiPolygon
+from shapely.ops import unary_union
+from geopandas import GeoDataFrame as GDF
+
+from utils.geo import get_utm_zone_epsg, explode_mp
+from utils.parallel import map_bounded
+from utils.profiling import profiled
+
+
+def read_valid_footprint(
+    path: Union[str, Path], max_size: int = 512
+) -> Union[Polygon, MultiPolygon]:
+    """
+    Vectorizes the valid data footprint of a section from a decimated read of its
+    dataset mask. The read size only depends on max_size, GDAL uses the overviews of
+    the section if they exist, so this is fast even for very large sections. The
+    footprint is accurate to about one decimated pixel.
+    Args:
+        path: Section path.
+        max_size: Maximum width/height of the decimated mask in pixels.
+    Returns:
+        The footprint of the valid pixels in EPSG:4326, empty if there are none.
+    """
+    with rasterio.open(path) as src:
+        scale = max(src.width / max_size, src.height / max_size, 1)
+        out_height = max(1, int(round(src.height / scale)))
+        out_width = max(1, int(round(src.width / scale)))
+        mask = src.dataset_mask(
+            out_shape=(out_height, out_width), resampling=Resampling.nearest
+        )
+        transform = src.transform * Affine.scale(
+            src.width / out_width, src.height / out_height
+        )
+        crs = src.crs
+
+    valid = (mask > 0).astype("uint8")
+    polygons = [
+        shape(geometry)
+        for geometry, _ in shapes(valid, mask=valid.astype(bool), transform=transform)
+    ]
+    if not polygons:
+        return Polygon()
+    footprint = unary_union(polygons)
+    return shape(transform_geom(crs, "EPSG:4326", footprint.__geo_interface__))
+
+
+@profiled
+def verify_coverage(
+    aoi: GDF,
+    section_paths: List[Union[str, Path]],
+    n_workers: Optional[int] = None,
+    max_size: int = 512,
+    min_gap_sqm: float = 1.0,
+) -> Tuple[float, GDF, GDF]:
+    """
+    Verifies the coverage of the AOI by the valid pixels of the delivered sections,
+    unlike coverage_percentage, which only checks the planned section geometries.
+    The section footprints are vectorized in parallel worker processes.
+    Args:
+        aoi: AOI.
+        section_paths: Paths of the delivered sections.
+        n_workers: Number of worker processes, defaults to the number of CPUs.
+        max_size: Maximum width/height of the decimated section masks in pixels.
+        min_gap_sqm: Gaps smaller than this area (m²) are dropped, e.g. slivers
+            from reprojecting the AOI and footprints.
+    Returns:
+        The percentage of the AOI covered by valid pixels, the uncovered parts of the
+        AOI (one row per gap, with area_sqkm) and the valid data footprints of the
+        sections (with path), both in EPSG:4326.
+    """
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        geometries = list(
+            map_bounded(
+                executor,
+                partial(read_valid_footprint, max_size=max_size),
+                [str(path) for path in section_paths],
+                n_workers=n_workers,
+            )
+        )
+    footprints = GDF(
+        {"path": [str(path) for path in section_paths]},
+        geometry=geometries,
+        crs="EPSG:4326",
+    )
+
+    aoi = aoi.to_crs(epsg=4326)
+    centroid = aoi.geometry.unary_union.centroid
+    epsg = get_utm_zone_epsg(lon=centroid.x, lat=centroid.y)
+    aoi_utm = aoi.to_crs(epsg=epsg).geometry.unary_union
+    covered = unary_union(
+        footprints[~footprints.is_empty].to_crs(epsg=epsg).geometry.tolist()
+    )
+
+    cov = float(np.clip(aoi_utm.intersection(covered).area / aoi_utm.area, 0, 1))
+    gaps = GDF(geometry=[aoi_utm.difference(covered)], crs=f"EPSG:{epsg}")
+    gaps = explode_mp(gaps[~gaps.is_empty])
+    gaps = gaps[gaps.area >= min_gap_sqm].reset_index(drop=True)
+    gaps["area_sqkm"] = gaps.area / 10 ** 6
+    return cov * 100, gaps.to_crs(epsg=4326), footprints
@@ -1,13 +1,27 @@
-from typing import Union
+from typing import Dict, List, Union, Optional, TYPE_CHECKING
 import math
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
 
 import shapely
-from shapely.geometry import Polygon, box
-from shapely.ops import transform, cascaded_union
-import pyproj
-import geopandas as gpd
-from geopandas import GeoDataFrame as GDF
-import pandas as pd
+from shapely.geometry import Polygon, MultiPolygon, GeometryCollection, box
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import transform, cascaded_union, unary_union
+from shapely.prepared import prep
+
+from utils.lazy import lazy_import
+from utils.profiling import profiled
+
+# The geometry core only needs shapely, the dataframe libraries are loaded on use.
+pyproj = lazy_import("pyproj")
+gpd = lazy_import("geopandas")
+pd = lazy_import("pandas")
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame as GDF
 
 
 # pylint: disable=chained-comparison
@@ -100,7 +114,8 @@ def reproject_shapely(
     return geometry_reprojected
 
 
-def explode_mp(df: GDF) -> GDF:
+@profiled
+def explode_mp(df: "GDF") -> "GDF":
     """
     Explode all multi-polygon geometries in a geodataframe into individual polygon
     geometries.
@@ -122,10 +137,285 @@ def explode_mp(df: GDF) -> GDF:
     return outdf
 
 
+def get_polygonal(geometry: BaseGeometry) -> Union[Polygon, MultiPolygon]:
+    """
+    Keeps the polygon parts of a clipped geometry (dropping touching lines and
+    points) and repairs invalid polygons.
+    """
+    if isinstance(geometry, GeometryCollection):
+        geometry = unary_union(
+            [part for part in geometry.geoms if isinstance(part, Polygon)]
+            or [Polygon()]
+        )
+    if not isinstance(geometry, (Polygon, MultiPolygon)):
+        return Polygon()
+    return geometry if geometry.is_valid else geometry.buffer(0)
+
+
+@profiled
+def clip_to_aoi(df: "GDF", aoi_geometry: BaseGeometry) -> "GDF":
+    """
+    Clips scene footprints to the AOI. The spatial index of the scenes limits the
+    work to the scenes intersecting the AOI bounds. Scenes that contain the AOI are
+    replaced by the AOI and scenes within the AOI are kept, without computing an
+    intersection.
+    Args:
+        df: Scenes, in the crs of the AOI geometry.
+        aoi_geometry: AOI geometry, e.g. the union of all AOI features.
+    Returns:
+        The scenes intersecting the AOI with their clipped geometries.
+    """
+    candidates = df.iloc[sorted(df.sindex.intersection(aoi_geometry.bounds))]
+    prepared = prep(aoi_geometry)
+    geometries = []
+    for geometry in candidates.geometry:
+        if not prepared.intersects(geometry):
+            geometries.append(Polygon())
+        elif prepared.contains(geometry):
+            geometries.append(geometry)
+        elif geometry.contains(aoi_geometry):
+            geometries.append(aoi_geometry)
+        else:
+            geometries.append(get_polygonal(geometry.intersection(aoi_geometry)))
+    clipped = candidates.copy()
+    clipped.geometry = gpd.GeoSeries(geometries, index=candidates.index, crs=df.crs)
+    return clipped[~clipped.is_empty]
+
+
+class NoDataError(Exception):
+    """
+    No scene section is large enough to optimize the coverage.
+    """
+
+
+# Criteria of WeightedScore, each is scaled to 0 (worst) to 1.
+SCORE_CRITERIA = ["cloudCoverage", "incidenceAngle", "recency", "area", "credits"]
+# Default weights. Credits are not used by default, the catalog has no prices and a
+# search only returns scenes of one sensor.
+SCORE_WEIGHTS = {
+    "cloudCoverage": 1.0,
+    "incidenceAngle": 0.5,
+    "recency": 0.25,
+    "area": 1.0,
+}
+
+
+class SectionScore:
+    """
+    Score of candidate sections for get_best_sections_full_coverage, higher is
+    better. Subclasses compute the score of many candidates at once.
+    """
+
+    def fit(self, df: "GDF", area_sqkm: np.ndarray):
+        """
+        Fixes the scales of the criteria on all candidates before the selection, so
+        that scores of later iterations stay comparable.
+        Args:
+            df: All candidate sections.
+            area_sqkm: Area of the candidates within the AOI.
+        """
+
+    def __call__(self, df: "GDF", area_sqkm: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            df: Candidate sections.
+            area_sqkm: Remaining (not yet covered) area of the candidates.
+        Returns:
+            The score of each candidate.
+        """
+        raise NotImplementedError
+
+
+class WeightedScore(SectionScore):
+    """
+    Weighted sum of cloud cover, incidence angle, acquisition recency, remaining
+    area and optionally estimated credits per sqkm. Criteria without a column in the
+    candidates are neutral, missing values score worst.
+    Args:
+        weights: Weight per criterion of SCORE_CRITERIA, defaults to SCORE_WEIGHTS.
+            Omitted criteria are not used.
+        credits_per_sqkm: Estimated credits per sqkm by constellation for the
+            credits criterion, used if the candidates have no creditsPerSqkm column.
+        max_incidence_angle: Incidence angle (degrees) scoring 0.
+    """
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        credits_per_sqkm: Optional[Dict[str, float]] = None,
+        max_incidence_angle: float = 50.0,
+    ):
+        self.weights = dict(SCORE_WEIGHTS if weights is None else weights)
+        unknown = set(self.weights) - set(SCORE_CRITERIA)
+        if unknown:
+            raise ValueError(f"Unknown score criteria {unknown}!")
+        self.credits_per_sqkm = credits_per_sqkm or {}
+        self.max_incidence_angle = max_incidence_angle
+        self.max_area_sqkm = 1.0
+        self.newest: Optional[float] = None
+        self.oldest: Optional[float] = None
+        self.max_credits = 1.0
+
+    def get_credits(self, df: "GDF") -> Optional[np.ndarray]:
+        if "creditsPerSqkm" in df:
+            return df["creditsPerSqkm"].to_numpy(dtype="float64")
+        if self.credits_per_sqkm and "constellation" in df:
+            return (
+                df["constellation"]
+                .astype(str)
+                .map(self.credits_per_sqkm)
+                .to_numpy(dtype="float64")
+            )
+        return None
+
+    @staticmethod
+    def get_timestamps(df: "GDF") -> Optional[np.ndarray]:
+        """Acquisition dates as seconds since the epoch."""
+        if "acquisitionDate" not in df:
+            return None
+        dates = pd.to_datetime(df["acquisitionDate"], utc=True)
+        return np.where(dates.isna(), np.nan, dates.astype("int64") / 10 ** 9)
+
+    def fit(self, df: "GDF", area_sqkm: np.ndarray):
+        self.max_area_sqkm = float(np.max(area_sqkm, initial=0)) or 1.0
+        timestamps = self.get_timestamps(df)
+        if timestamps is not None and not np.isnan(timestamps).all():
+            self.newest, self.oldest = np.nanmax(timestamps), np.nanmin(timestamps)
+        credit_costs = self.get_credits(df)
+        if credit_costs is not None and not np.isnan(credit_costs).all():
+            self.max_credits = float(np.nanmax(credit_costs)) or 1.0
+
+    def __call__(self, df: "GDF", area_sqkm: np.ndarray) -> np.ndarray:
+        criteria = {"area": np.asarray(area_sqkm, dtype="float64") / self.max_area_sqkm}
+        if "cloudCoverage" in df:
+            criteria["cloudCoverage"] = (
+                1 - df["cloudCoverage"].to_numpy("float64") / 100
+            )
+        if "incidenceAngle" in df:
+            criteria["incidenceAngle"] = (
+                1 - df["incidenceAngle"].to_numpy("float64") / self.max_incidence_angle
+            )
+        timestamps = self.get_timestamps(df)
+        if timestamps is not None and self.newest is not None:
+            criteria["recency"] = 1 - (self.newest - timestamps) / max(
+                self.newest - self.oldest, 1  # type: ignore
+            )
+        credit_costs = self.get_credits(df)
+        if credit_costs is not None:
+            criteria["credits"] = 1 - credit_costs / self.max_credits
+
+        score = np.zeros(len(df))
+        for name, weight in self.weights.items():
+            if name in criteria:
+                score += weight * np.nan_to_num(np.clip(criteria[name], 0, 1), nan=0)
+        return score
+
+
+# pylint: disable=too-many-locals, too-many-statements
+@profiled
+def get_best_sections_scored(
+    df: "GDF", score: SectionScore, min_size_section_sqkm: float = 0.5
+) -> "GDF":
+    """
+    Greedily selects the sections with the best score until the AOI is covered, see
+    get_best_sections_full_coverage. The scores are kept in a heap, after each
+    selection only the candidates intersecting the selected section are updated.
+    Args:
+        df: Scenes clipped to the AOI.
+        score: Score of the candidates, e.g. WeightedScore().
+        min_size_section_sqkm: Minimum area of a section.
+    Returns:
+        The selected sections in EPSG:4326 with the columns of df, area_sqkm_clipped,
+        score and full_coverage (area of the section in sqkm).
+    """
+    centroid = box(*df.total_bounds).centroid
+    epsg = get_utm_zone_epsg(lon=centroid.x, lat=centroid.y)
+    df = df.to_crs(epsg=epsg)
+
+    area_sqkm = (df.area / 10 ** 6).to_numpy()
+    candidates = df[area_sqkm > min_size_section_sqkm].reset_index(drop=True)
+    area_sqkm = area_sqkm[area_sqkm > min_size_section_sqkm]
+    if candidates.shape[0] == 0:
+        raise NoDataError(
+            "No data matches optimize parameters! Try again by running a wider search!"
+        )
+    candidates["area_sqkm_clipped"] = area_sqkm
+    remaining = list(candidates.geometry)
+
+    score.fit(candidates, area_sqkm)
+    scores = score(candidates, area_sqkm)
+    # Entries are (-score, candidate, version), outdated versions are skipped.
+    heap = [(-s, i, 0) for i, s in enumerate(scores)]
+    heapq.heapify(heap)
+    versions = np.zeros(len(candidates), dtype=int)
+    active = np.ones(len(candidates), dtype=bool)
+
+    selected: List[int] = []
+    sections: List[Polygon] = []
+    section_scores: List[float] = []
+    covered: BaseGeometry = Polygon()
+    while heap:
+        negative_score, i, version = heapq.heappop(heap)
+        if not active[i] or version != versions[i]:
+            continue
+        active[i] = False
+        parts = [
+            part
+            for part in getattr(remaining[i], "geoms", [remaining[i]])
+            if part.area / 10 ** 6 > min_size_section_sqkm
+        ]
+        if not parts:
+            continue
+        selected.extend([i] * len(parts))
+        sections.extend(parts)
+        section_scores.extend([-negative_score] * len(parts))
+
+        # Only the remaining area of overlapping candidates changes.
+        section = unary_union(parts)
+        prepared = prep(section)
+        changed = np.array(
+            [
+                j
+                for j in candidates.sindex.intersection(section.bounds)
+                if active[j] and prepared.intersects(remaining[j])
+            ],
+            dtype=int,
+        )
+        if not changed.size:
+            continue
+        # Subtracting the union of all sections from the footprints, instead of
+        # each section from the remaining geometries, avoids accumulating slivers.
+        covered = covered.union(section)
+        for j in changed:
+            remaining[j] = get_polygonal(
+                candidates.geometry.iloc[j].difference(covered)
+            )
+            area_sqkm[j] = remaining[j].area / 10 ** 6
+        active[changed[area_sqkm[changed] <= min_size_section_sqkm]] = False
+        changed = changed[active[changed]]
+        versions[changed] += 1
+        for j, s in zip(changed, score(candidates.iloc[changed], area_sqkm[changed])):
+            heapq.heappush(heap, (-s, j, versions[j]))
+
+    full_coverage = candidates.iloc[selected].reset_index(drop=True)
+    full_coverage.geometry = gpd.GeoSeries(sections, crs=f"EPSG:{epsg}")
+    full_coverage["score"] = section_scores
+    full_coverage["full_coverage"] = full_coverage.area / 10 ** 6
+    full_coverage.geometry = full_coverage.geometry.buffer(0)
+    full_coverage = full_coverage.to_crs(epsg=4326)
+    full_coverage = explode_mp(full_coverage)
+    full_coverage.geometry = full_coverage.geometry.buffer(0)
+    return full_coverage
+
+
 # Allows passing of list for ordering
 # pylint: disable=dangerous-default-value
+@profiled
 def get_best_sections_full_coverage(
-    df, order_by=["cloudCoverage"], min_size_section_sqkm=0.5
+    df,
+    order_by=["cloudCoverage"],
+    min_size_section_sqkm=0.5,
+    score: Optional[SectionScore] = None,
 ):
     """
     Ordered by order_by column, and automatically area_sqkm_clipped
@@ -133,8 +423,14 @@ def get_best_sections_full_coverage(
     :param order_by: E.g. ["cloudCoverage", "incidenceAngle"], third order will always be area.
         Be aware that this will to many small sections, better filter incidence angle by treshold.
     :param min_size_section_sqkm:
+    :param score: Ranks by a score (e.g. WeightedScore()) instead of order_by, see
+        get_best_sections_scored.
     :return:
     """
+    if score is not None:
+        return get_best_sections_scored(
+            df, score=score, min_size_section_sqkm=min_size_section_sqkm
+        )
     centroid = box(*df.total_bounds).centroid
     epsg = get_utm_zone_epsg(lon=centroid.x, lat=centroid.y)
     df = df.to_crs(epsg=epsg)
@@ -143,7 +439,7 @@ def get_best_sections_full_coverage(
     df = df.sort_values(by=[*order_by, "area_sqkm_clipped"], axis=0, ascending=False)
     df = df[df["area_sqkm_clipped"] > min_size_section_sqkm]
     if df.shape[0] == 0:
-        raise Exception(
+        raise NoDataError(
             "No data matches optimize parameters! Try again by running a wider search!"
         )
 
@@ -210,7 +506,8 @@ def get_best_sections_full_coverage(
     return full_coverage
 
 
-def coverage_percentage(aoi: GDF, full_coverage: GDF) -> float:
+@profiled
+def coverage_percentage(aoi: "GDF", full_coverage: "GDF") -> float:
     """
     Calculates percentage of coverage of AOI from full_coverage.
     """
@@ -220,6 +517,63 @@ def coverage_percentage(aoi: GDF, full_coverage: GDF) -> float:
     full_coverage = full_coverage.to_crs(epsg=epsg)
     aoi = aoi.to_crs(epsg=epsg)
 
-    unary_union = gpd.GeoSeries(cascaded_union(full_coverage.geometry))
-    cov = (unary_union.area / aoi.area) * 100
+    # The AOI may consist of several features.
+    covered = cascaded_union(full_coverage.geometry)
+    cov = (covered.area / aoi.unary_union.area) * 100
     return float(cov)
+
+
+def get_best_sections_aoi_feature(
+    feature: BaseGeometry, df: "GDF", **kwargs
+) -> Optional["GDF"]:
+    """
+    Optimizes the coverage of a single AOI feature, see
+    get_best_sections_per_feature. Returns None if no scene section of the feature
+    is large enough, e.g. for a feature smaller than min_size_section_sqkm.
+    """
+    clipped = clip_to_aoi(df, feature)
+    if clipped.empty:
+        return None
+    try:
+        return get_best_sections_full_coverage(df=clipped, **kwargs)
+    except NoDataError:
+        return None
+
+
+@profiled
+def get_best_sections_per_feature(
+    df: "GDF", aoi: "GDF", n_workers: Optional[int] = None, **kwargs
+) -> "GDF":
+    """
+    Optimizes the coverage of each feature of a multi-feature AOI separately, in
+    parallel worker processes. Unlike for the union of the features, a scene can be
+    selected for some features only.
+    Args:
+        df: Scenes, in EPSG:4326.
+        aoi: AOI with one or more features.
+        n_workers: Number of worker processes, defaults to the number of CPUs.
+        kwargs: Arguments of get_best_sections_full_coverage, e.g. order_by.
+    Returns:
+        The sections of all features in EPSG:4326, with the index of the AOI feature
+        in column aoi_feature. Features without intersecting scenes or large enough
+        sections are skipped.
+    """
+    features = aoi.to_crs(epsg=4326).geometry.tolist()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        sections = list(
+            executor.map(
+                partial(get_best_sections_aoi_feature, df=df, **kwargs), features
+            )
+        )
+    feature_sections = [
+        feature_df.assign(aoi_feature=i)
+        for i, feature_df in enumerate(sections)
+        if feature_df is not None
+    ]
+    if not feature_sections:
+        raise NoDataError(
+            "No data matches optimize parameters! Try again by running a wider search!"
+        )
+    return gpd.GeoDataFrame(
+        pd.concat(feature_sections, ignore_index=True), crs="EPSG:4326"
+    )
@@ -0,0 +1,27 @@
+import sys
+import importlib.util
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Imports a module lazily, it is only loaded on first attribute access. Keeps
+    importing utils fast for headless workers that don't need the heavy
+    dependencies of the notebook.
+    Args:
+        name: Module name, e.g. "geopandas". Parent packages of submodules are
+            imported right away.
+    Returns:
+        The (not yet loaded) module.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
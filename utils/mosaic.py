@@ -0,0 +1,1503 @@
+# pylint: disable=too-many-lines
+import os
+import json
+import math
+import hashlib
+import itertools
+import time
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Union, Optional, Iterable, Tuple, Callable
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from contextlib import contextmanager, ExitStack
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio import windows
+from rasterio.windows import Window
+from rasterio.coords import BoundingBox
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_bounds, calculate_default_transform
+from rasterio.vrt import WarpedVRT
+from rasterio.crs import CRS
+from rasterio.merge import merge
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.plot import plotting_extent
+from affine import Affine
+from shapely.geometry import Polygon, LineString, box
+from shapely.ops import unary_union
+from shapely import wkt
+import geopandas as gpd
+from geopandas import GeoDataFrame as GDF
+
+from utils.parallel import map_bounded
+from utils.profiling import profiled
+
+
+MOSAIC_COLORINTERP = [
+    ColorInterp.red,
+    ColorInterp.green,
+    ColorInterp.blue,
+    ColorInterp.undefined,
+]
+
+
+def get_section_bounds(
+    section_paths: List[Union[str, Path]], crs: Optional[CRS] = None
+) -> List[BoundingBox]:
+    """
+    Reads the bounds of all section rasters, optionally transformed to another crs.
+    """
+    section_bounds = []
+    for fp in section_paths:
+        with rasterio.open(fp) as src:
+            if crs is None or src.crs == crs:
+                section_bounds.append(src.bounds)
+            else:
+                section_bounds.append(
+                    BoundingBox(*transform_bounds(src.crs, crs, *src.bounds))
+                )
+    return section_bounds
+
+
+def get_target_grid(
+    section_paths: List[Union[str, Path]],
+    epsg: int,
+    res: Optional[float] = None,
+    resampling: Resampling = Resampling.bilinear,
+) -> dict:
+    """
+    Defines a common grid to warp sections with different crs or resolution onto.
+    Args:
+        section_paths: Paths of the section rasters.
+        epsg: Target crs epsg code, e.g. the UTM zone of the AOI (get_utm_zone_epsg).
+        res: Target resolution in crs units, by default the finest section
+            resolution in the target crs (rounded to 2 decimals).
+        resampling: Resampling of the warped sections, nearest neighbour gives
+            blocky, shifted edges when changing the resolution.
+    Returns:
+        The grid crs, resolution and resampling, pixels are aligned to multiples of
+        the resolution.
+    """
+    crs = CRS.from_epsg(epsg)
+    if res is None:
+        resolutions = []
+        for fp in section_paths:
+            with rasterio.open(fp) as src:
+                transform, _, _ = calculate_default_transform(
+                    src.crs, crs, src.width, src.height, *src.bounds
+                )
+            resolutions.append(min(abs(transform.a), abs(transform.e)))
+        res = round(min(resolutions), 2)
+    return {"crs": crs, "res": res, "resampling": resampling}
+
+
+# pylint: disable=too-many-locals
+def get_mosaic_profile(
+    section_paths: List[Union[str, Path]],
+    blocksize: int = 256,
+    bounds: Optional[tuple] = None,
+    grid: Optional[dict] = None,
+) -> dict:
+    """
+    Calculates the output profile of the mosaic of all sections, i.e. the union of the
+    section bounds at the resolution of the first section (same grid as rasterio merge).
+    Args:
+        section_paths: Paths of the section rasters.
+        blocksize: Internal tile size of the output GeoTIFF.
+        bounds: Optional (left, bottom, right, top) mosaic extent in the crs of the
+            mosaic instead of the union of the section bounds. Snapped outwards to
+            the pixel grid of the first section.
+        grid: Optional target grid (see get_target_grid) instead of the crs and pixel
+            grid of the first section.
+    Returns:
+        Rasterio profile of the mosaic.
+    """
+    with rasterio.open(section_paths[0]) as first:
+        out_profile = first.profile.copy()
+        if grid is None:
+            crs = first.crs
+            res_x, res_y = first.res
+            first_left, first_top = first.bounds.left, first.bounds.top
+        else:
+            crs = grid["crs"]
+            res_x, res_y = grid["res"], grid["res"]
+            first_left, first_top = 0, 0
+
+    if bounds is None:
+        section_bounds = get_section_bounds(section_paths, crs)
+        left = min(b.left for b in section_bounds)
+        bottom = min(b.bottom for b in section_bounds)
+        right = max(b.right for b in section_bounds)
+        top = max(b.top for b in section_bounds)
+    if bounds is not None or grid is not None:
+        if bounds is None:
+            bounds = (left, bottom, right, top)
+        # Tolerance of 1/100 pixel for reprojection round-off.
+        left = first_left + math.floor((bounds[0] - first_left) / res_x + 0.01) * res_x
+        right = first_left + math.ceil((bounds[2] - first_left) / res_x - 0.01) * res_x
+        top = first_top - math.floor((first_top - bounds[3]) / res_y + 0.01) * res_y
+        bottom = first_top - math.ceil((first_top - bounds[1]) / res_y - 0.01) * res_y
+
+    out_transform = rasterio.transform.from_origin(left, top, res_x, res_y)
+    out_profile.update(
+        {
+            "driver": "GTiff",
+            "crs": crs,
+            "height": int(round((top - bottom) / res_y)),
+            "width": int(round((right - left) / res_x)),
+            "transform": out_transform,
+            "blockxsize": blocksize,
+            "blockysize": blocksize,
+            "tiled": True,  # Important for definition block structure!
+        }
+    )
+    return out_profile
+
+
+@contextmanager
+def open_section(
+    fp: Union[str, Path], profile: dict, resampling: Resampling = Resampling.nearest
+):
+    """
+    Opens a section raster on the mosaic grid. Sections with a different crs,
+    resolution or pixel alignment are lazily warped through a WarpedVRT aligned to
+    the mosaic grid, so only the pixels of the read windows are reprojected.
+    Args:
+        fp: Path of the section raster.
+        profile: Mosaic profile, see get_mosaic_profile.
+        resampling: Resampling of warped sections, see get_target_grid.
+    """
+    transform = profile["transform"]
+    with rasterio.open(fp) as src:
+        col_off, row_off = ~transform * (src.transform.c, src.transform.f)
+        if (
+            src.crs == profile["crs"]
+            and src.transform.a == transform.a
+            and src.transform.e == transform.e
+            and abs(col_off - round(col_off)) < 0.01
+            and abs(row_off - round(row_off)) < 0.01
+        ):
+            yield src
+        else:
+            window = windows.from_bounds(
+                *transform_bounds(src.crs, profile["crs"], *src.bounds), transform
+            )
+            window = window.round_offsets(op="floor").round_lengths(op="ceil")
+            with WarpedVRT(
+                src,
+                crs=profile["crs"],
+                transform=windows.transform(window, transform),
+                width=window.width + 1,
+                height=window.height + 1,
+                resampling=resampling,
+            ) as vrt:
+                yield vrt
+
+
+def get_tile_windows(width: int, height: int, tile_size: int = 1024) -> List[Window]:
+    """
+    Splits a raster grid into row-major tile windows, edge tiles are clipped to the grid.
+    """
+    return [
+        Window(
+            col_off,
+            row_off,
+            min(tile_size, width - col_off),
+            min(tile_size, height - row_off),
+        )
+        for row_off in range(0, height, tile_size)
+        for col_off in range(0, width, tile_size)
+    ]
+
+
+def get_tile_sections(
+    tile_windows: List[Window], footprints: List[Polygon], transform: Affine
+) -> List[List[int]]:
+    """
+    Finds the sections overlapping each tile window, keeps the section order.
+    Args:
+        tile_windows: Tile windows in the mosaic grid.
+        footprints: Footprint of each section in the mosaic crs, e.g. the raster
+            bounds or the section cutline.
+        transform: Mosaic transform.
+    Returns:
+        Indices of the sections overlapping each tile.
+    """
+    tile_sections = []
+    for window in tile_windows:
+        tile_box = box(*windows.bounds(window, transform))
+        tile_sections.append(
+            [
+                i
+                for i, footprint in enumerate(footprints)
+                if footprint.intersects(tile_box) and not footprint.touches(tile_box)
+            ]
+        )
+    return tile_sections
+
+
+def align_window(window: Window) -> Window:
+    """
+    Rounds a window to whole pixels like rasterio merge (based on gdal_merge.py).
+    """
+    return Window(
+        math.floor(window.col_off + 0.1),
+        math.floor(window.row_off + 0.1),
+        math.floor(window.width + 0.5),
+        math.floor(window.height + 0.5),
+    )
+
+
+def empty_tile(window: Window, profile: dict) -> np.ndarray:
+    return np.full(
+        (profile["count"], window.height, window.width),
+        profile["nodata"] or 0,
+        dtype=profile["dtype"],
+    )
+
+
+def composite_tile(
+    window: Window,
+    tile_sections: List[Tuple[Union[str, Path], Polygon]],
+    profile: dict,
+    resampling: Resampling = Resampling.nearest,
+) -> np.ndarray:
+    """
+    Composites one output tile of the mosaic from the sections (first section wins).
+    Opens its own dataset handles, so it can run in a worker process.
+    Args:
+        window: Tile window in the mosaic grid.
+        tile_sections: Path and footprint of the sections overlapping the tile, only
+            the paths are used.
+        profile: Mosaic profile, see get_mosaic_profile.
+        resampling: Resampling of warped sections, see get_target_grid.
+    Returns:
+        Array of shape (bands, window.height, window.width).
+    """
+    if not tile_sections:
+        return empty_tile(window, profile)
+    transform = profile["transform"]
+    with ExitStack() as stack:
+        sources = [
+            stack.enter_context(open_section(fp, profile, resampling))
+            for fp, _ in tile_sections
+        ]
+        tile, _ = merge(
+            sources,
+            bounds=windows.bounds(window, transform),
+            res=(transform.a, -transform.e),
+            nodata=profile["nodata"],
+        )
+    return tile
+
+
+def read_cutline_window(
+    src: rasterio.io.DatasetReader,
+    geometry: Polygon,
+    tile_transform: Affine,
+    tile_shape: Tuple[int, ...],
+) -> Optional[Tuple[Window, np.ma.MaskedArray, np.ndarray]]:
+    """
+    Reads the pixels of a section raster under a geometry on the grid of a tile.
+    Args:
+        src: Section raster.
+        geometry: Geometry in the mosaic crs, e.g. a section cutline.
+        tile_transform: Transform of the tile.
+        tile_shape: Height and width of the tile.
+    Returns:
+        None if the geometry does not overlap the tile and raster. Otherwise the read
+        window in the tile, the data of the window and the mask of the pixels within
+        the geometry.
+    """
+    tile_box = box(*windows.bounds(Window(0, 0, *tile_shape[::-1]), tile_transform))
+    part = geometry.intersection(tile_box).intersection(box(*src.bounds))
+    if part.is_empty:
+        return None
+    try:
+        cw = align_window(
+            windows.from_bounds(*part.bounds, tile_transform)
+        ).intersection(Window(0, 0, *tile_shape[::-1]))
+    except WindowError:
+        return None
+    if cw.width == 0 or cw.height == 0:
+        return None
+    data = src.read(
+        window=windows.from_bounds(*windows.bounds(cw, tile_transform), src.transform),
+        out_shape=(src.count, cw.height, cw.width),
+        masked=True,
+    )
+    inside = geometry_mask(
+        [part],
+        out_shape=(cw.height, cw.width),
+        transform=windows.transform(cw, tile_transform),
+        invert=True,
+    )
+    return cw, data, inside
+
+
+# pylint: disable=too-many-locals
+def composite_tile_cutlines(
+    window: Window,
+    tile_sections: List[Tuple[Union[str, Path], Polygon]],
+    profile: dict,
+    feather: bool = False,
+    resampling: Resampling = Resampling.nearest,
+) -> np.ndarray:
+    """
+    Composites one output tile of the mosaic, each section only contributes the pixels
+    within its cutline (first section wins). Only the window under the cutline is read
+    from each section raster. Opens its own dataset handles, so it can run in a
+    worker process.
+    Args:
+        window: Tile window in the mosaic grid.
+        tile_sections: Path and cutline (in the mosaic crs) of the sections
+            overlapping the tile.
+        profile: Mosaic profile, see get_mosaic_profile.
+        feather: Blends the overlap strips of the cutlines, see feather_seams.
+        resampling: Resampling of warped sections, see get_target_grid.
+    Returns:
+        Array of shape (bands, window.height, window.width).
+    """
+    tile = empty_tile(window, profile)
+    empty = np.ones((window.height, window.width), dtype=bool)
+    tile_transform = windows.transform(window, profile["transform"])
+
+    for fp, cutline in tile_sections:
+        with open_section(fp, profile, resampling) as src:
+            result = read_cutline_window(src, cutline, tile_transform, empty.shape)
+        if result is None:
+            continue
+        cw, data, inside = result
+        rows, cols = cw.toslices()
+        update = inside & empty[rows, cols] & ~np.ma.getmaskarray(data).all(axis=0)
+        tile[:, rows, cols][:, update] = data.data[:, update]
+        empty[rows, cols] &= ~update
+
+    if feather and len(tile_sections) > 1:
+        feather_seams(tile, tile_transform, tile_sections, profile, resampling)
+    return tile
+
+
+def iter_lines(geometry) -> Iterable[LineString]:
+    """
+    Yields all (linear ring) line strings in a geometry or geometry collection.
+    """
+    if geometry.geom_type in ["LineString", "LinearRing"]:
+        yield geometry
+    elif hasattr(geometry, "geoms"):
+        for part in geometry.geoms:
+            yield from iter_lines(part)
+
+
+def distance_to_lines(
+    xs: np.ndarray, ys: np.ndarray, lines, chunk_size: int = 2 ** 22
+) -> np.ndarray:
+    """
+    Euclidean distance of points to the closest segment of line geometries,
+    vectorized over the points and segments.
+    Args:
+        xs: X coordinates of the points.
+        ys: Y coordinates of the points.
+        lines: (Multi)LineString or geometry collection, other parts are ignored.
+        chunk_size: Maximum number of point-segment pairs computed at once.
+    Returns:
+        Distances in the shape of xs, inf without any line segment.
+    """
+    segments = [
+        np.hstack([coords[:-1], coords[1:]])
+        for coords in (np.asarray(line.coords)[:, :2] for line in iter_lines(lines))
+        if len(coords) > 1
+    ]
+    distance = np.full(xs.shape, np.inf)
+    if not segments:
+        return distance
+    x1, y1, x2, y2 = np.vstack(segments).T
+    dx, dy = x2 - x1, y2 - y1
+    length = np.maximum(dx * dx + dy * dy, np.finfo(float).tiny)
+
+    flat_xs, flat_ys, flat_distance = xs.ravel(), ys.ravel(), distance.ravel()
+    step = max(1, chunk_size // len(x1))
+    for i in range(0, flat_xs.size, step):
+        px = flat_xs[i : i + step, None] - x1
+        py = flat_ys[i : i + step, None] - y1
+        t = np.clip((px * dx + py * dy) / length, 0, 1)
+        flat_distance[i : i + step] = np.hypot(px - t * dx, py - t * dy).min(axis=1)
+    return distance
+
+
+# pylint: disable=too-many-locals
+def feather_seams(
+    tile: np.ndarray,
+    tile_transform: Affine,
+    tile_sections: List[Tuple[Union[str, Path], Polygon]],
+    profile: dict,
+    resampling: Resampling = Resampling.nearest,
+) -> np.ndarray:
+    """
+    Blends the overlap strips of the (buffered) section cutlines of a composited tile
+    with distance based weights, all other pixels are left as they are. The weight of
+    a section is the distance to its own cutline edge within the other sections, so
+    it ramps from 0 at its edge to the full strip width at the opposite edge.
+    Distances are only computed for the strip pixels, to the seam edges clipped to
+    the surroundings of the tile and simplified to a tenth of the pixel size.
+    Args:
+        tile: Composited tile, updated in place.
+        tile_transform: Transform of the tile.
+        tile_sections: Path and cutline (in the mosaic crs) of the sections
+            overlapping the tile.
+        profile: Mosaic profile, see get_mosaic_profile.
+        resampling: Resampling of warped sections, see get_target_grid.
+    Returns:
+        The blended tile.
+    """
+    tile_shape = tile.shape[1:]
+    tile_box = box(*windows.bounds(Window(0, 0, *tile_shape[::-1]), tile_transform))
+    cutlines = [cutline for _, cutline in tile_sections]
+    all_strips = unary_union(
+        [a.intersection(b) for a, b in itertools.combinations(cutlines, 2)]
+    )
+    strips = all_strips.intersection(tile_box)
+    if strips.area == 0:
+        return tile
+    try:
+        sw = align_window(
+            windows.from_bounds(*strips.bounds, tile_transform)
+        ).intersection(Window(0, 0, *tile_shape[::-1]))
+    except WindowError:
+        return tile
+    strip_transform = windows.transform(sw, tile_transform)
+    in_strips = geometry_mask(
+        [strips],
+        out_shape=(sw.height, sw.width),
+        transform=strip_transform,
+        invert=True,
+    )
+    if not in_strips.any():
+        return tile
+
+    # The edge closest to a strip pixel is at most about a strip width (twice the
+    # area per boundary length) away, farther edges don't need to be measured.
+    pixel_size = abs(tile_transform.a)
+    margin = 4 * all_strips.area / all_strips.length + pixel_size
+    edge_box = tile_box.buffer(margin, join_style=2)
+
+    weighted = np.zeros((tile.shape[0], sw.height, sw.width))
+    weights = np.zeros((sw.height, sw.width))
+
+    for i, (fp, cutline) in enumerate(tile_sections):
+        if not cutline.intersects(strips):
+            continue
+        with open_section(fp, profile, resampling) as src:
+            result = read_cutline_window(
+                src, cutline.intersection(strips), strip_transform, weights.shape
+            )
+        if result is None:
+            continue
+        cw, data, inside = result
+        # Seam edge of the section, without edges shared with other sections
+        # (e.g. the AOI outline).
+        others = unary_union(cutlines[:i] + cutlines[i + 1 :])
+        edge = (
+            cutline.boundary.difference(others.boundary.buffer(pixel_size / 10))
+            .intersection(others)
+            .intersection(edge_box)
+            .simplify(pixel_size / 10)
+        )
+        rw, cl = cw.toslices()
+        blend = inside & ~np.ma.getmaskarray(data).all(axis=0) & in_strips[rw, cl]
+        rows, cols = np.nonzero(blend)
+        xs, ys = windows.transform(cw, strip_transform) * (cols + 0.5, rows + 0.5)
+        weight = distance_to_lines(np.asarray(xs), np.asarray(ys), edge)
+        weight[np.isinf(weight)] = 1
+        rows, cols = rows + cw.row_off, cols + cw.col_off
+        weighted[:, rows, cols] += data.data[:, blend] * weight
+        weights[rows, cols] += weight
+
+    blend = in_strips & (weights > 0)
+    region = tile[
+        :, sw.row_off : sw.row_off + sw.height, sw.col_off : sw.col_off + sw.width
+    ]
+    blended = weighted[:, blend] / weights[blend]
+    if np.issubdtype(tile.dtype, np.integer):
+        blended = np.rint(blended)
+    region[:, blend] = blended
+    return tile
+
+
+def write_tiles(
+    dst: rasterio.io.DatasetWriter, tile_windows: List[Window], tiles: Iterable
+):
+    """
+    Writes the composited tiles in the order of their windows.
+    """
+    for window, tile in zip(tile_windows, tiles):
+        dst.write(tile, window=window)
+
+
+def set_mosaic_colorinterp(dst: rasterio.io.DatasetWriter):
+    dst.colorinterp = MOSAIC_COLORINTERP[: dst.count]
+
+
+@profiled
+def match_section_files(
+    sections: GDF, section_paths: List[Union[str, Path]]
+) -> Tuple[GDF, List[Union[str, Path]], GDF]:
+    """
+    Maps the downloaded section rasters to the optimized sections (e.g.
+    full_coverage_buffered.geojson) by the intersection over union of raster bounds
+    and section geometry.
+    Args:
+        sections: Optimized sections, in optimizer priority order.
+        section_paths: Paths of the downloaded section rasters.
+    Returns:
+        The sections with a raster, in the same order, with an additional "path"
+        column. Also the rasters without a section and the sections without a
+        raster, which are missing from a mosaic of the matched sections.
+    """
+    raster_boxes = []
+    for fp in section_paths:
+        with rasterio.open(fp) as src:
+            raster_boxes.append(
+                box(*transform_bounds(src.crs, sections.crs.to_wkt(), *src.bounds))
+            )
+
+    candidates = []
+    for i_file, raster_box in enumerate(raster_boxes):
+        for i_section, geometry in enumerate(sections.geometry):
+            intersection = raster_box.intersection(geometry).area
+            if intersection > 0:
+                iou = intersection / raster_box.union(geometry).area
+                candidates.append((iou, i_file, i_section))
+
+    section_files: Dict[int, int] = {}
+    for _, i_file, i_section in sorted(candidates, reverse=True):
+        if i_section not in section_files and i_file not in section_files.values():
+            section_files[i_section] = i_file
+
+    matched = sections.iloc[sorted(section_files)].copy()
+    matched["path"] = [section_paths[section_files[i]] for i in sorted(section_files)]
+    unmatched_paths = [
+        fp for i, fp in enumerate(section_paths) if i not in section_files.values()
+    ]
+    unmatched_sections = sections.iloc[
+        [i for i in range(len(sections)) if i not in section_files]
+    ]
+    return matched, unmatched_paths, unmatched_sections
+
+
+def prepare_mosaic(
+    section_paths: List[Union[str, Path]],
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    grid: Optional[dict] = None,
+) -> Tuple[dict, List[Polygon], Callable]:
+    """
+    Calculates the mosaic profile, the section footprints in the mosaic crs and the
+    tile compositing function, see mosaic_parallel for the arguments.
+    """
+    profile = get_mosaic_profile(section_paths, grid=grid)
+    resampling = Resampling.nearest if grid is None else grid["resampling"]
+    if cutlines is None:
+        footprints = [
+            box(*bounds) for bounds in get_section_bounds(section_paths, profile["crs"])
+        ]
+        composite = partial(composite_tile, profile=profile, resampling=resampling)
+    else:
+        footprints = list(cutlines.to_crs(profile["crs"].to_wkt()))
+        profile = get_mosaic_profile(
+            section_paths, bounds=unary_union(footprints).bounds, grid=grid
+        )
+        composite = partial(
+            composite_tile_cutlines,
+            profile=profile,
+            feather=feather,
+            resampling=resampling,
+        )
+    return profile, footprints, composite
+
+
+def get_mosaic_options(
+    tile_size: int,
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    grid: Optional[dict] = None,
+) -> dict:
+    """
+    Compositing options of a mosaic as stored in its manifest.
+    """
+    return {
+        "tile_size": tile_size,
+        "cutlines": cutlines is not None,
+        "feather": feather,
+        "grid": None
+        if grid is None
+        else [grid["crs"].to_string(), grid["res"], grid["resampling"].name],
+    }
+
+
+@profiled
+def composite_tiles(
+    dst: rasterio.io.DatasetWriter,
+    tile_windows: List[Window],
+    section_paths: List[Union[str, Path]],
+    footprints: List[Polygon],
+    composite: Callable,
+    n_workers: Optional[int] = None,
+):
+    """
+    Composites the tile windows in worker processes and writes them in order.
+    Args:
+        dst: Opened mosaic.
+        tile_windows: Tile windows to composite.
+        section_paths: Paths of the section rasters.
+        footprints: Footprints of the sections in the mosaic crs.
+        composite: Tile compositing function, see prepare_mosaic.
+        n_workers: Number of worker processes, with 1 the tiles are composited in the
+            current process.
+    """
+    tile_sections = [
+        [(section_paths[i], footprints[i]) for i in indices]
+        for indices in get_tile_sections(tile_windows, footprints, dst.transform)
+    ]
+    if n_workers == 1:
+        write_tiles(dst, tile_windows, map(composite, tile_windows, tile_sections))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            write_tiles(
+                dst,
+                tile_windows,
+                map_bounded(
+                    executor,
+                    composite,
+                    tile_windows,
+                    tile_sections,
+                    n_workers=n_workers,
+                ),
+            )
+
+
+def get_overview_factors(width: int, height: int, blocksize: int = 256) -> List[int]:
+    """
+    Overview factors (2, 4, 8, ...) until the overview fits into one block.
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+# pylint: disable=too-many-arguments
+@profiled
+def mosaic_parallel(
+    section_paths: List[Union[str, Path]],
+    out_path: Union[str, Path],
+    n_workers: Optional[int] = None,
+    tile_size: int = 1024,
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    overviews: bool = False,
+    grid: Optional[dict] = None,
+    compress: Optional[str] = None,
+) -> Path:
+    """
+    Creates the mosaic GeoTIFF by compositing independent tile windows in worker
+    processes. A single writer receives the finished tiles in order. Also writes a
+    manifest of the sections, which allows incremental updates (see update_mosaic).
+    Args:
+        section_paths: Paths of the section rasters, earlier sections win in overlaps.
+        out_path: Output GeoTIFF path.
+        n_workers: Number of worker processes, defaults to the number of cpus. With 1
+            the tiles are composited in the current process.
+        tile_size: Size of the compositing windows in pixels, should be a multiple of
+            the 256 pixel block size.
+        cutlines: Optional section geometry for each section raster, e.g. from
+            match_section_files. Each section then only contributes (and reads) the
+            pixels within its geometry, and the mosaic is limited to their extent.
+        feather: Blends the seams in the overlap strips of the cutlines instead of
+            the first section winning, see feather_seams.
+        overviews: Builds internal overviews (average resampling).
+        grid: Optional common grid (see get_target_grid), sections with a different
+            crs or resolution are warped onto it window by window in the workers.
+        compress: Optional lossless GeoTIFF compression, e.g. "DEFLATE".
+    Returns:
+        The output path.
+    """
+    out_path = Path(out_path)
+    profile, footprints, composite = prepare_mosaic(
+        section_paths, cutlines, feather, grid
+    )
+    if compress is not None:
+        profile.update(
+            compress=compress,
+            predictor=3
+            if np.issubdtype(np.dtype(profile["dtype"]), np.floating)
+            else 2,
+            num_threads="ALL_CPUS",
+        )
+    tile_windows = get_tile_windows(profile["width"], profile["height"], tile_size)
+
+    # The manifest of a previous mosaic must not describe a partially written one.
+    get_manifest_path(out_path).unlink(missing_ok=True)
+
+    with rasterio.open(out_path, "w", **profile) as dst:
+        composite_tiles(
+            dst, tile_windows, section_paths, footprints, composite, n_workers
+        )
+        set_mosaic_colorinterp(dst)
+        if overviews:
+            dst.build_overviews(
+                get_overview_factors(dst.width, dst.height), Resampling.average
+            )
+    write_manifest(
+        out_path,
+        section_paths,
+        footprints,
+        get_mosaic_options(tile_size, cutlines, feather, grid),
+    )
+    return out_path
+
+
+def file_checksum(path: Union[str, Path]) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_manifest_path(mosaic_path: Union[str, Path]) -> Path:
+    return Path(mosaic_path).with_suffix(".json")
+
+
+def get_manifest_sections(
+    mosaic_path: Union[str, Path],
+    section_paths: List[Union[str, Path]],
+    footprints: List[Polygon],
+    previous: Optional[dict] = None,
+) -> List[dict]:
+    """
+    Describes the sections of a mosaic by path (relative to the mosaic), size,
+    modification time, sha256 checksum and footprint (WKT in the mosaic crs).
+    Checksums of unchanged files (same size and modification time) are taken from
+    the previous manifest sections instead of being recalculated.
+    """
+    previous_sections = {s["path"]: s for s in (previous or {}).get("sections", [])}
+    mosaic_dir = Path(mosaic_path).resolve().parent
+    sections = []
+    for fp, footprint in zip(section_paths, footprints):
+        stat = Path(fp).stat()
+        section = {
+            "path": os.path.relpath(Path(fp).resolve(), mosaic_dir),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "footprint": footprint.wkt,
+        }
+        before = previous_sections.get(section["path"])
+        if (
+            before is not None
+            and before["size"] == section["size"]
+            and before["mtime"] == section["mtime"]
+        ):
+            section["checksum"] = before["checksum"]
+        else:
+            section["checksum"] = file_checksum(fp)
+        sections.append(section)
+    return sections
+
+
+def write_manifest(
+    mosaic_path: Union[str, Path],
+    section_paths: List[Union[str, Path]],
+    footprints: List[Polygon],
+    options: dict,
+    previous: Optional[dict] = None,
+) -> Path:
+    """
+    Writes the manifest of a mosaic next to it (mosaic.json for mosaic.tif).
+    Args:
+        mosaic_path: Mosaic path.
+        section_paths: Paths of the section rasters, in priority order.
+        footprints: Footprints of the sections in the mosaic crs.
+        options: Compositing options (tile_size, cutlines, feather).
+        previous: Previous manifest to take unchanged checksums from.
+    Returns:
+        The manifest path.
+    """
+    manifest = {
+        **options,
+        "sections": get_manifest_sections(
+            mosaic_path, section_paths, footprints, previous
+        ),
+    }
+    manifest_path = get_manifest_path(mosaic_path)
+    manifest_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+    return manifest_path
+
+
+def get_changed_footprints(previous: List[dict], current: List[dict]) -> List[Polygon]:
+    """
+    Compares the manifest sections of two mosaic versions.
+    Returns:
+        Old and new footprints of all added, removed or modified sections, and of
+        sections with a changed priority order.
+    """
+    previous_by_path = {s["path"]: s for s in previous}
+    current_by_path = {s["path"]: s for s in current}
+
+    changed = [s for s in previous if s["path"] not in current_by_path]
+    for section in current:
+        before = previous_by_path.get(section["path"])
+        if before is None:
+            changed.append(section)
+        elif (
+            before["checksum"] != section["checksum"]
+            or before["footprint"] != section["footprint"]
+        ):
+            changed.extend([before, section])
+
+    previous_order = [s["path"] for s in previous if s["path"] in current_by_path]
+    current_order = [s["path"] for s in current if s["path"] in previous_by_path]
+    for path_before, path_now in zip(previous_order, current_order):
+        if path_before != path_now:
+            changed.extend([previous_by_path[path_before], current_by_path[path_now]])
+
+    return [wkt.loads(s["footprint"]) for s in changed]
+
+
+def downsample_average(data: np.ma.MaskedArray, factor: int) -> np.ma.MaskedArray:
+    """
+    Averages blocks of factor x factor pixels ignoring masked pixels, edge blocks
+    may be smaller (same overview size as GDAL).
+    """
+    count, height, width = data.shape
+    out_height, out_width = -(-height // factor), -(-width // factor)
+    padded = np.ma.masked_all(
+        (count, out_height * factor, out_width * factor), dtype="float64"
+    )
+    padded[:, :height, :width] = data
+    blocks = padded.reshape(count, out_height, factor, out_width, factor)
+    return blocks.mean(axis=(2, 4))
+
+
+# pylint: disable=too-many-locals
+@profiled
+def refresh_overviews(mosaic_path: Union[str, Path], tile_windows: List[Window]):
+    """
+    Recalculates the internal overview pixels (average resampling) covering the
+    given tile windows of the full resolution mosaic.
+    """
+    with rasterio.open(mosaic_path) as src:
+        factors = src.overviews(1)
+        nodata = src.nodata if src.nodata is not None else 0
+        dtype = src.dtypes[0]
+        width, height = src.width, src.height
+        for level, factor in enumerate(factors):
+            ovr_windows = []
+            for window in tile_windows:
+                col_off = window.col_off // factor
+                row_off = window.row_off // factor
+                ovr_windows.append(
+                    Window(
+                        col_off,
+                        row_off,
+                        -(-(window.col_off + window.width) // factor) - col_off,
+                        -(-(window.row_off + window.height) // factor) - row_off,
+                    )
+                )
+            ovr_tiles = []
+            for ovr_window in ovr_windows:
+                data = src.read(
+                    window=Window(
+                        ovr_window.col_off * factor,
+                        ovr_window.row_off * factor,
+                        min(
+                            ovr_window.width * factor,
+                            width - ovr_window.col_off * factor,
+                        ),
+                        min(
+                            ovr_window.height * factor,
+                            height - ovr_window.row_off * factor,
+                        ),
+                    ),
+                    masked=True,
+                )
+                averaged = downsample_average(data, factor)
+                if np.issubdtype(np.dtype(dtype), np.integer):
+                    averaged = np.ma.round(averaged)
+                ovr_tiles.append(averaged.filled(nodata).astype(dtype))
+            with rasterio.open(mosaic_path, "r+", overview_level=level) as ovr:
+                write_tiles(ovr, ovr_windows, ovr_tiles)
+
+
+class IncrementalUpdateError(Exception):
+    """The mosaic can not be updated incrementally, it has to be rebuilt."""
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+@profiled
+def update_mosaic(
+    mosaic_path: Union[str, Path],
+    section_paths: List[Union[str, Path]],
+    n_workers: Optional[int] = None,
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    grid: Optional[dict] = None,
+) -> int:
+    """
+    Incrementally updates a mosaic created by mosaic_parallel after sections were
+    replaced, added, removed or reordered. Only the tiles touching the old or new
+    footprints of the changed sections are composited again and rewritten in place,
+    then the overviews of these tiles are refreshed.
+    Args:
+        mosaic_path: Path of the mosaic GeoTIFF, with its manifest next to it.
+        section_paths: See mosaic_parallel.
+        n_workers: See mosaic_parallel.
+        cutlines: See mosaic_parallel.
+        feather: See mosaic_parallel.
+        grid: See mosaic_parallel.
+    Returns:
+        Number of updated tiles.
+    Raises:
+        IncrementalUpdateError: If the mosaic can not be updated incrementally (no
+            manifest, different compositing options or mosaic extent), rebuild it
+            instead.
+    """
+    manifest_path = get_manifest_path(mosaic_path)
+    if not manifest_path.is_file() or not Path(mosaic_path).is_file():
+        raise IncrementalUpdateError(
+            f"No mosaic with manifest {manifest_path} found, rebuild the mosaic."
+        )
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    options = get_mosaic_options(manifest["tile_size"], cutlines, feather, grid)
+    if any(manifest.get(key) != value for key, value in options.items()):
+        raise IncrementalUpdateError("Compositing options changed, rebuild the mosaic.")
+
+    profile, footprints, composite = prepare_mosaic(
+        section_paths, cutlines, feather, grid
+    )
+    with rasterio.open(mosaic_path) as src:
+        if (src.width, src.height, src.transform) != (
+            profile["width"],
+            profile["height"],
+            profile["transform"],
+        ):
+            raise IncrementalUpdateError("Mosaic extent changed, rebuild the mosaic.")
+
+    sections = get_manifest_sections(mosaic_path, section_paths, footprints, manifest)
+    changed = get_changed_footprints(manifest["sections"], sections)
+    tile_windows = []
+    if changed:
+        changed_area = unary_union(changed)
+        tile_windows = [
+            window
+            for window in get_tile_windows(
+                profile["width"], profile["height"], manifest["tile_size"]
+            )
+            if changed_area.intersects(
+                box(*windows.bounds(window, profile["transform"]))
+            )
+        ]
+    if tile_windows:
+        with rasterio.open(mosaic_path, "r+") as dst:
+            composite_tiles(
+                dst, tile_windows, section_paths, footprints, composite, n_workers
+            )
+        refresh_overviews(mosaic_path, tile_windows)
+
+    write_manifest(mosaic_path, section_paths, footprints, options, manifest)
+    return len(tile_windows)
+
+
+# pylint: disable=too-many-arguments
+def update_or_create_mosaic(
+    mosaic_path: Union[str, Path],
+    section_paths: List[Union[str, Path]],
+    n_workers: Optional[int] = None,
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    grid: Optional[dict] = None,
+    compress: Optional[str] = None,
+) -> Optional[int]:
+    """
+    Updates the tiles of changed sections of an existing mosaic (see update_mosaic),
+    or creates the full mosaic with overviews if it can not be updated incrementally
+    (see mosaic_parallel).
+    Args:
+        mosaic_path: Path of the mosaic GeoTIFF.
+        section_paths: See mosaic_parallel.
+        n_workers: See mosaic_parallel.
+        cutlines: See mosaic_parallel.
+        feather: See mosaic_parallel.
+        grid: See mosaic_parallel.
+        compress: See mosaic_parallel, only used when creating the mosaic.
+    Returns:
+        Number of updated tiles, None if the full mosaic was created.
+    """
+    try:
+        return update_mosaic(
+            mosaic_path, section_paths, n_workers, cutlines, feather, grid
+        )
+    except IncrementalUpdateError:
+        mosaic_parallel(
+            section_paths,
+            mosaic_path,
+            n_workers=n_workers,
+            cutlines=cutlines,
+            feather=feather,
+            overviews=True,
+            grid=grid,
+            compress=compress,
+        )
+        return None
+
+
+GDAL_DTYPES = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+# pylint: disable=too-many-locals
+@profiled
+def build_vrt(
+    section_paths: List[Union[str, Path]], vrt_path: Union[str, Path]
+) -> Path:
+    """
+    Creates an instant GDAL VRT mosaic referencing the sections instead of copying
+    their pixels. Sources are written in reverse order, as in a VRT the last source
+    wins, so earlier sections win in overlaps (same as the GeoTIFF mosaic). The full
+    sections are used, without cutlines, feathering or warping.
+    Args:
+        section_paths: Paths of the section rasters, earlier sections win in overlaps.
+        vrt_path: Output VRT path, sections are referenced relative to it.
+    Returns:
+        The output path.
+    Raises:
+        ValueError: If the sections differ in crs or resolution.
+    """
+    vrt_path = Path(vrt_path)
+    profile = get_mosaic_profile(section_paths)
+    transform = profile["transform"]
+    nodata = profile["nodata"]
+
+    vrt = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(profile["width"]),
+        rasterYSize=str(profile["height"]),
+    )
+    ET.SubElement(vrt, "SRS").text = profile["crs"].to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(
+        repr(v) for v in transform.to_gdal()
+    )
+    bands = []
+    for i in range(profile["count"]):
+        band = ET.SubElement(
+            vrt,
+            "VRTRasterBand",
+            dataType=GDAL_DTYPES[profile["dtype"]],
+            band=str(i + 1),
+        )
+        if nodata is not None:
+            ET.SubElement(band, "NoDataValue").text = repr(nodata)
+        colorinterp = (
+            MOSAIC_COLORINTERP[i]
+            if i < len(MOSAIC_COLORINTERP)
+            else ColorInterp.undefined
+        )
+        ET.SubElement(band, "ColorInterp").text = colorinterp.name.capitalize()
+        bands.append(band)
+
+    for fp in reversed(section_paths):
+        with rasterio.open(fp) as src:
+            # GDAL would silently resample the sections onto the first one's grid.
+            if src.crs != profile["crs"] or not np.allclose(
+                src.res, (abs(transform.a), abs(transform.e))
+            ):
+                raise ValueError(
+                    "VRT mosaics require all sections in the same crs and "
+                    "resolution, use a GeoTIFF mosaic with a target grid instead."
+                )
+            dst_window = windows.from_bounds(*src.bounds, transform)
+            src_nodata = src.nodata
+            src_width, src_height = src.width, src.height
+        relative_path = os.path.relpath(Path(fp).resolve(), vrt_path.resolve().parent)
+        for i, band in enumerate(bands):
+            source = ET.SubElement(band, "ComplexSource")
+            ET.SubElement(
+                source, "SourceFilename", relativeToVRT="1"
+            ).text = relative_path
+            ET.SubElement(source, "SourceBand").text = str(i + 1)
+            ET.SubElement(
+                source,
+                "SrcRect",
+                xOff="0",
+                yOff="0",
+                xSize=str(src_width),
+                ySize=str(src_height),
+            )
+            ET.SubElement(
+                source,
+                "DstRect",
+                xOff=repr(dst_window.col_off),
+                yOff=repr(dst_window.row_off),
+                xSize=repr(dst_window.width),
+                ySize=repr(dst_window.height),
+            )
+            if src_nodata is not None:
+                ET.SubElement(source, "NODATA").text = repr(src_nodata)
+
+    ET.ElementTree(vrt).write(str(vrt_path))
+    return vrt_path
+
+
+@profiled
+def materialize_vrt(
+    vrt_path: Union[str, Path],
+    out_path: Union[str, Path],
+    bounds: Optional[tuple] = None,
+    tile_size: int = 1024,
+) -> Path:
+    """
+    Materializes a VRT mosaic (see build_vrt) into a tiled GeoTIFF, window by window.
+    Args:
+        vrt_path: Input VRT path.
+        out_path: Output GeoTIFF path.
+        bounds: Optional (left, bottom, right, top) sub-window in the mosaic crs,
+            by default the full mosaic is materialized.
+        tile_size: Size of the read/write windows in pixels.
+    Returns:
+        The output path.
+    """
+    out_path = Path(out_path)
+    with rasterio.open(vrt_path) as src:
+        full_window = Window(0, 0, src.width, src.height)
+        if bounds is None:
+            window = full_window
+        else:
+            window = (
+                windows.from_bounds(*bounds, src.transform)
+                .round_offsets()
+                .round_lengths()
+                .intersection(full_window)
+            )
+        profile = src.profile.copy()
+        profile.update(
+            {
+                "driver": "GTiff",
+                "height": window.height,
+                "width": window.width,
+                "transform": windows.transform(window, src.transform),
+                "blockxsize": 256,
+                "blockysize": 256,
+                "tiled": True,
+            }
+        )
+        tile_windows = get_tile_windows(window.width, window.height, tile_size)
+        tiles = (
+            src.read(
+                window=Window(
+                    window.col_off + tile.col_off,
+                    window.row_off + tile.row_off,
+                    tile.width,
+                    tile.height,
+                )
+            )
+            for tile in tile_windows
+        )
+        with rasterio.open(out_path, "w", **profile) as dst:
+            write_tiles(dst, tile_windows, tiles)
+            set_mosaic_colorinterp(dst)
+    return out_path
+
+
+COG_CODECS = ["DEFLATE", "ZSTD", "LZW", "JPEG", "WEBP"]
+
+
+def check_cog_codec(codec: str, count: int, dtype: str, alpha: bool = False) -> str:
+    """
+    Checks that a COG codec supports the bands of a mosaic, before writing it.
+    Args:
+        codec: One of COG_CODECS.
+        count: Number of bands of the mosaic.
+        dtype: Data type of the mosaic.
+        alpha: If the 4th band is an alpha band.
+    Returns:
+        The codec in upper case.
+    Raises:
+        ValueError: If the codec is unknown, or lossy and the mosaic is not 8 bit RGB
+            (WEBP also RGBA).
+    """
+    codec = codec.upper()
+    if codec not in COG_CODECS:
+        raise ValueError(f"Codec {codec} not supported, use one of {COG_CODECS}.")
+    if codec in ["JPEG", "WEBP"]:
+        rgb = dtype == "uint8" and (
+            count == 3 or (codec == "WEBP" and count == 4 and alpha)
+        )
+        if not rgb:
+            raise ValueError(
+                f"{codec} requires an 8 bit RGB mosaic"
+                f"{' (or RGBA with an alpha band)' if codec == 'WEBP' else ''}, got "
+                f"{count} {dtype} bands. Use a lossless codec instead."
+            )
+    return codec
+
+
+@profiled
+def write_cog(
+    src_path: Union[str, Path],
+    out_path: Union[str, Path],
+    codec: str = "DEFLATE",
+    quality: int = 90,
+    blocksize: int = 256,
+) -> dict:
+    """
+    Converts a mosaic (GeoTIFF or VRT) into a Cloud-Optimized GeoTIFF. Compression and
+    internal overviews are created in one pass by the GDAL COG driver.
+    Args:
+        src_path: Input mosaic path.
+        out_path: Output COG path.
+        codec: One of COG_CODECS. DEFLATE, ZSTD and LZW are lossless and use a
+            predictor, JPEG and WEBP are lossy and only work for 8 bit RGB mosaics,
+            see check_cog_codec.
+        quality: Quality of the lossy codecs (1-100).
+        blocksize: Internal tile size of the COG.
+    Returns:
+        Output path, output size (MB), write time (s) and write throughput
+        (uncompressed MB/s).
+    """
+    with rasterio.open(src_path) as src:
+        count, dtype = src.count, src.dtypes[0]
+        size_uncompressed = src.width * src.height * count * np.dtype(dtype).itemsize
+        alpha = count == 4 and src.colorinterp[3] == ColorInterp.alpha
+    codec = check_cog_codec(codec, count, dtype, alpha)
+
+    options = {
+        "COMPRESS": codec,
+        "BLOCKSIZE": blocksize,
+        "OVERVIEWS": "AUTO",
+        "NUM_THREADS": "ALL_CPUS",
+    }
+    if codec in ["JPEG", "WEBP"]:
+        options["QUALITY"] = quality
+    else:
+        options["PREDICTOR"] = "YES"
+
+    out_path = Path(out_path)
+    start = time.perf_counter()
+    written = False
+    try:
+        rasterio.shutil.copy(str(src_path), str(out_path), driver="COG", **options)
+        duration = time.perf_counter() - start
+        errors = validate_cog(out_path)
+        if errors:
+            raise ValueError(f"{out_path} is not a valid COG: {errors}")
+        written = True
+    finally:
+        # No partial or invalid COG is left behind.
+        if not written:
+            out_path.unlink(missing_ok=True)
+
+    return {
+        "path": out_path,
+        "codec": codec,
+        "size_mb": out_path.stat().st_size / 10 ** 6,
+        "seconds": duration,
+        "throughput_mb_s": size_uncompressed / 10 ** 6 / duration,
+    }
+
+
+# pylint: disable=too-many-arguments
+@profiled
+def mosaic_cog(
+    section_paths: List[Union[str, Path]],
+    out_path: Union[str, Path],
+    codec: str = "DEFLATE",
+    n_workers: Optional[int] = None,
+    cutlines: Optional[gpd.GeoSeries] = None,
+    feather: bool = False,
+    grid: Optional[dict] = None,
+) -> dict:
+    """
+    Creates the mosaic as a Cloud-Optimized GeoTIFF. The tiles are composited into a
+    losslessly compressed working copy with overviews, which the COG driver then
+    copies. COGs can not be edited, so the working copy is kept next to the COG
+    (with its manifest): when creating the COG again, only the tiles of changed
+    sections are composited into the working copy (see update_or_create_mosaic).
+    The COG is then still rewritten completely from it, unless no tile changed and
+    the existing COG has the requested codec. The codec is checked before
+    compositing.
+    Args:
+        section_paths: See mosaic_parallel.
+        out_path: Output COG path, the working copy is {stem}_working.tif next to it.
+        codec: See write_cog.
+        n_workers: See mosaic_parallel.
+        cutlines: See mosaic_parallel.
+        feather: See mosaic_parallel.
+        grid: See mosaic_parallel.
+    Returns:
+        See write_cog, also the number of updated tiles of the working copy
+        (updated_tiles, None if it was created) and if the COG was rewritten
+        (rewritten, the seconds and throughput are None otherwise).
+    """
+    out_path = Path(out_path)
+    profile = get_mosaic_profile(section_paths, grid=grid)
+    codec = check_cog_codec(codec, profile["count"], profile["dtype"])
+
+    working_path = out_path.with_name(f"{out_path.stem}_working.tif")
+    # A stale manifest of a previous non COG mosaic at the output path.
+    get_manifest_path(out_path).unlink(missing_ok=True)
+    try:
+        updated_tiles = update_or_create_mosaic(
+            working_path,
+            section_paths,
+            n_workers=n_workers,
+            cutlines=cutlines,
+            feather=feather,
+            grid=grid,
+            compress="DEFLATE",
+        )
+    except BaseException:
+        # Only a partially created working copy (it has no manifest yet) is removed,
+        # a partially updated one is fixed by the next update.
+        if not get_manifest_path(working_path).is_file():
+            working_path.unlink(missing_ok=True)
+        raise
+
+    if (
+        updated_tiles == 0
+        and out_path.is_file()
+        and out_path.stat().st_mtime >= working_path.stat().st_mtime
+        and not validate_cog(out_path)
+    ):
+        with rasterio.open(out_path) as src:
+            compression = src.compression.name.upper() if src.compression else None
+        if compression == codec:
+            return {
+                "path": out_path,
+                "codec": codec,
+                "size_mb": out_path.stat().st_size / 10 ** 6,
+                "seconds": None,
+                "throughput_mb_s": None,
+                "updated_tiles": updated_tiles,
+                "rewritten": False,
+            }
+    return {
+        **write_cog(working_path, out_path, codec),
+        "updated_tiles": updated_tiles,
+        "rewritten": True,
+    }
+
+
+def validate_cog(path: Union[str, Path]) -> List[str]:
+    """
+    Checks the Cloud-Optimized GeoTIFF layout: GDAL COG structural metadata at the
+    start of the file (IFDs before data), internal tiling and internal overviews
+    for rasters bigger than one block.
+    Returns:
+        List of errors, empty for a valid COG.
+    """
+    errors = []
+    with open(path, "rb") as f:
+        header = f.read(1024)
+    if b"LAYOUT=IFDS_BEFORE_DATA" not in header:
+        errors.append("IFDs are not located before the image data.")
+    if b"KNOWN_INCOMPATIBLE_EDITION=NO" not in header:
+        errors.append("File was edited after creation, COG layout may be broken.")
+
+    with rasterio.open(path) as src:
+        if src.driver != "GTiff":
+            errors.append(f"Driver is {src.driver}, not GTiff.")
+        _, block_width = src.block_shapes[0]
+        if not src.profile.get("tiled") and src.width > 512:
+            errors.append("Raster is not internally tiled.")
+        if max(src.width, src.height) > block_width and not src.overviews(1):
+            errors.append("Raster has no internal overviews.")
+        if any(
+            ovr_path
+            for ovr_path in src.files
+            if Path(ovr_path).suffix.lower() == ".ovr"
+        ):
+            errors.append("Raster has external overviews.")
+    return errors
+
+
+def get_percentile_ranges(
+    data: np.ma.MaskedArray, percentiles: tuple = (2, 98)
+) -> List[Optional[Tuple[float, float]]]:
+    """
+    Gets the contrast stretch range of each band from the percentiles of its valid
+    pixels.
+    Args:
+        data: Masked array of shape (bands, height, width).
+        percentiles: Lower and upper percentile for the contrast stretch.
+    Returns:
+        (low, high) per band, None for bands without valid pixels.
+    """
+    ranges: List[Optional[Tuple[float, float]]] = []
+    for band in data:
+        valid = band.compressed()
+        if valid.size == 0:
+            ranges.append(None)
+            continue
+        low, high = np.percentile(valid, percentiles)
+        ranges.append((float(low), float(high)))
+    return ranges
+
+
+@profiled
+def read_preview(
+    path: Union[str, Path], max_size: int = 1024, percentiles: tuple = (2, 98)
+) -> Tuple[np.ndarray, tuple]:
+    """
+    Reads a decimated RGB(A) preview of a mosaic for plotting. The read size only
+    depends on max_size, GDAL uses the overviews of the mosaic if they exist. Each band
+    is contrast stretched to the given percentiles of its valid preview pixels.
+    Args:
+        path: Mosaic path.
+        max_size: Maximum width/height of the preview in pixels, e.g. the figure size
+            in pixels.
+        percentiles: Lower and upper percentile for the contrast stretch.
+    Returns:
+        Preview array of shape (height, width, 4) with values in 0-1 (alpha is 0
+        for nodata pixels), and the plotting extent (left, right, bottom, top).
+    """
+    with rasterio.open(path) as src:
+        scale = max(src.width / max_size, src.height / max_size, 1)
+        indexes = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+        data = src.read(
+            indexes=indexes,
+            out_shape=(
+                len(indexes),
+                max(1, int(src.height / scale)),
+                max(1, int(src.width / scale)),
+            ),
+            masked=True,
+            resampling=Resampling.nearest,
+        )
+        extent = plotting_extent(src)
+
+    preview = np.zeros((data.shape[1], data.shape[2], 4), dtype="float32")
+    for i, (band, band_range) in enumerate(
+        zip(data, get_percentile_ranges(data, percentiles))
+    ):
+        if band_range is None:
+            continue
+        low, high = band_range
+        preview[..., i] = np.clip(
+            (band.filled(low) - low) / max(high - low, 1e-9), 0, 1
+        )
+    preview[..., 3] = ~np.ma.getmaskarray(data).all(axis=0)
+    return preview, extent
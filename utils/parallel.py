@@ -0,0 +1,44 @@
+import os
+import itertools
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Callable, Deque, Iterable, Iterator, List, Optional
+
+
+def _map_chunk(fn: Callable, chunk: List[tuple]) -> list:
+    return [fn(*args) for args in chunk]
+
+
+def map_bounded(
+    executor: Executor,
+    fn: Callable,
+    *iterables: Iterable,
+    n_workers: Optional[int] = None,
+    chunksize: int = 1,
+    max_pending: Optional[int] = None,
+) -> Iterator:
+    """
+    Like executor.map, but only submits new work while at most max_pending chunks
+    are in flight. Results are yielded in order, so finished results wait for a slow
+    earlier one or a slow consumer (e.g. a single writer) only within this bound.
+    Args:
+        executor: Executor, e.g. a ProcessPoolExecutor.
+        fn: Function, called with one item of each iterable.
+        iterables: Arguments of fn.
+        n_workers: Number of workers of the executor, defaults to the number of CPUs.
+        chunksize: Number of calls submitted to a worker at once.
+        max_pending: Maximum number of chunks in flight, defaults to 2 * n_workers.
+    Yields:
+        The results of fn in the order of the arguments.
+    """
+    max_pending = max_pending or 2 * (n_workers or os.cpu_count() or 1)
+    arguments = zip(*iterables)
+    pending: Deque[Future] = deque()
+    while True:
+        chunk = list(itertools.islice(arguments, chunksize))
+        if chunk:
+            pending.append(executor.submit(_map_chunk, fn, chunk))
+        if pending and (len(pending) >= max_pending or not chunk):
+            yield from pending.popleft().result()
+        elif not chunk:
+            return
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import resource
+import threading
+import multiprocessing
+from typing import List, Union, Optional, Callable
+from pathlib import Path
+from datetime import datetime, timezone
+from functools import wraps
+from contextlib import contextmanager
+
+from utils.lazy import lazy_import
+
+requests = lazy_import("requests")
+
+# Stages currently being recorded, the innermost last.
+_STAGES: List[dict] = []
+_LOCK = threading.Lock()
+_RECORDS_PATH: Optional[Path] = None
+# The original requests.Session.send while stages are recorded.
+_SEND: Optional[Callable] = None
+# Stops the memory sampling thread while stages are recorded.
+_STOP_SAMPLING: Optional[threading.Event] = None
+SAMPLE_INTERVAL_SECONDS = 0.1
+
+
+def set_records_path(path: Optional[Union[str, Path]]):
+    """
+    Sets the JSON lines file that stage records are appended to, None to only print
+    the summaries.
+    """
+    global _RECORDS_PATH  # pylint: disable=global-statement
+    _RECORDS_PATH = Path(path) if path is not None else None
+
+
+def get_records_path() -> Optional[Path]:
+    return _RECORDS_PATH
+
+
+def get_rss_mb(pid: Union[int, str] = "self") -> float:
+    """Current resident set size of a process in MB, 0 if it is not available."""
+    try:
+        with open(f"/proc/{pid}/statm", encoding="ascii") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0.0
+    return pages * resource.getpagesize() / 2 ** 20
+
+
+def get_children_pids() -> List[str]:
+    """
+    Process ids of the child processes (e.g. workers) of this process, from the
+    children lists of its threads. Falls back to the multiprocessing children on
+    kernels without these lists.
+    """
+    children_paths = list(Path("/proc/self/task").glob("*/children"))
+    if not children_paths:
+        return [str(child.pid) for child in multiprocessing.active_children()]
+    pids = []
+    for children_path in children_paths:
+        try:
+            pids.extend(children_path.read_text(encoding="ascii").split())
+        except OSError:
+            continue
+    return pids
+
+
+def get_children_rss_mb() -> float:
+    """Current resident set size of all child processes (e.g. workers) in MB."""
+    return sum(get_rss_mb(pid) for pid in get_children_pids())
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of this process (VmHWM, Linux only).
+    Returns:
+        If the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident set size of this process since the last reset_peak_rss in MB."""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss (KB on Linux) is the peak of the whole process lifetime.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_cpu_seconds() -> tuple:
+    """CPU time of this process and of its finished child processes in seconds."""
+    times = os.times()
+    return times.user + times.system, times.children_user + times.children_system
+
+
+def _sample_memory():
+    """Updates the peak memory of the recorded stages."""
+    rss, children_rss = get_rss_mb(), get_children_rss_mb()
+    with _LOCK:
+        for stage in _STAGES:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], rss)
+            stage["children_peak_rss_mb"] = max(
+                stage["children_peak_rss_mb"], children_rss
+            )
+
+
+def _sample_memory_until(stop: threading.Event):
+    while not stop.wait(SAMPLE_INTERVAL_SECONDS):
+        _sample_memory()
+
+
+def _record_api_call(seconds: float):
+    with _LOCK:
+        for stage in _STAGES:
+            stage["api_calls"] += 1
+            stage["api_seconds"] += seconds
+            stage["api_max_seconds"] = max(stage["api_max_seconds"], seconds)
+
+
+def _timed_send(session, request, **kwargs):
+    start = time.perf_counter()
+    try:
+        return _SEND(session, request, **kwargs)  # type: ignore
+    finally:
+        _record_api_call(time.perf_counter() - start)
+
+
+@contextmanager
+def record_stage(name: str):
+    """
+    Records wall time, CPU time, memory and the HTTP (API) requests of a workflow
+    stage. Functions decorated with profiled that run during the stage are recorded
+    as spans of the stage. The peak memory of the stage is sampled in a background
+    thread, for the outermost stage the exact peak of the process is used (Linux).
+    Args:
+        name: Stage name.
+    Yields:
+        The stage record, complete after the context exits.
+    """
+    global _SEND, _STOP_SAMPLING  # pylint: disable=global-statement
+    rss = get_rss_mb()
+    stage: dict = {
+        "stage": name,
+        "started": datetime.now(timezone.utc).isoformat(),
+        "api_calls": 0,
+        "api_seconds": 0.0,
+        "api_max_seconds": 0.0,
+        "spans": {},
+        "error": None,
+        "peak_rss_mb": rss,
+        "children_peak_rss_mb": get_children_rss_mb(),
+    }
+    cpu, children_cpu = get_cpu_seconds()
+    start = time.perf_counter()
+    exact_peak = False
+    with _LOCK:
+        outermost = not _STAGES
+        if outermost:
+            # All up42 API calls and downloads go through requests sessions.
+            _SEND = requests.Session.send
+            requests.Session.send = _timed_send
+            # Resetting the peak within nested stages would break the outer ones.
+            exact_peak = reset_peak_rss()
+            _STOP_SAMPLING = threading.Event()
+            threading.Thread(
+                target=_sample_memory_until, args=(_STOP_SAMPLING,), daemon=True
+            ).start()
+        _STAGES.append(stage)
+    try:
+        yield stage
+    except BaseException as e:
+        stage["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _sample_memory()
+        with _LOCK:
+            _STAGES.remove(stage)
+            if not _STAGES:
+                requests.Session.send = _SEND
+                _STOP_SAMPLING.set()  # type: ignore
+        end_cpu, end_children_cpu = get_cpu_seconds()
+        stage["wall_seconds"] = time.perf_counter() - start
+        stage["cpu_seconds"] = end_cpu - cpu
+        stage["children_cpu_seconds"] = end_children_cpu - children_cpu
+        if outermost and exact_peak:
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], get_peak_rss_mb())
+        stage["rss_delta_mb"] = get_rss_mb() - rss
+
+
+def profiled(func: Callable) -> Callable:
+    """
+    Decorator that records the wall time, CPU time and number of calls of a function
+    as a span of the stages currently recorded. No overhead besides a check if no
+    stage is recorded.
+    """
+    name = f"{func.__module__}.{func.__name__}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _STAGES:
+            return func(*args, **kwargs)
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall_seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu
+            with _LOCK:
+                for stage in _STAGES:
+                    span = stage["spans"].setdefault(
+                        name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+                    )
+                    span["calls"] += 1
+                    span["wall_seconds"] += wall_seconds
+                    span["cpu_seconds"] += cpu_seconds
+
+    return wrapper
+
+
+def format_stage(stage: dict) -> str:
+    """Human readable summary of a stage record."""
+    lines = [
+        f"{stage['stage']}: {stage['wall_seconds']:.2f} s wall, "
+        f"{stage['cpu_seconds']:.2f} s CPU "
+        f"(+{stage['children_cpu_seconds']:.2f} s worker processes), "
+        f"peak RSS {stage['peak_rss_mb']:.0f} MB "
+        f"({stage['rss_delta_mb']:+.0f} MB, "
+        f"workers {stage['children_peak_rss_mb']:.0f} MB), "
+        f"{stage['api_calls']} API calls ({stage['api_seconds']:.2f} s, "
+        f"max {stage['api_max_seconds']:.2f} s)"
+    ]
+    for name, span in sorted(
+        stage["spans"].items(), key=lambda item: -item[1]["wall_seconds"]
+    ):
+        lines.append(
+            f"  {name}: {span['calls']}x, {span['wall_seconds']:.2f} s wall, "
+            f"{span['cpu_seconds']:.2f} s CPU"
+        )
+    return "\n".join(lines)
+
+
+def write_stage(stage: dict, path: Union[str, Path]):
+    """Appends a stage record as a JSON line."""
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(stage) + "\n")
@@ -0,0 +1,231 @@
+import json
+import sqlite3
+from typing import List, Union, Optional, Iterable, TYPE_CHECKING
+from pathlib import Path
+
+from shapely import wkb
+from shapely.geometry.base import BaseGeometry
+from shapely.prepared import prep
+
+from utils.lazy import lazy_import
+from utils.profiling import profiled
+
+rtree = lazy_import("rtree")
+gpd = lazy_import("geopandas")
+pd = lazy_import("pandas")
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame as GDF
+
+# Shared by all AOIs, so that every search adds to the known scenes.
+DEFAULT_SCENE_INDEX_PATH = Path.home() / ".mosaicking" / "scenes"
+
+SCENE_COLUMNS = [
+    "id",
+    "scene_id",
+    "sensor",
+    "acquisitionDate",
+    "cloudCoverage",
+    "incidenceAngle",
+    "blockNames",
+]
+
+# Catalog constellations of the sensors that can be searched.
+SENSOR_CONSTELLATIONS = {"pleiades": ["PHR"], "spot": ["SPOT"]}
+
+# SQLite limits the number of variables per statement.
+QUERY_CHUNK_SIZE = 900
+
+
+def to_float(value) -> Optional[float]:
+    """Converts a numeric attribute for SQLite, missing values to None."""
+    if value is None or pd.isna(value):
+        return None
+    return float(value)
+
+
+def get_sensor(constellation: Optional[str]) -> Optional[str]:
+    """Gets the sensor name of a catalog constellation, e.g. "pleiades" for "PHR"."""
+    for sensor, constellations in SENSOR_CONSTELLATIONS.items():
+        if constellation in constellations:
+            return sensor
+    return constellation
+
+
+def to_isoformat(value) -> Optional[str]:
+    """Converts an acquisition date to a naive UTC ISO string, comparable in SQL."""
+    if value is None or pd.isna(value):
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp.isoformat()
+
+
+class SceneIndex:
+    """
+    Persistent spatial index of the scene footprints returned by catalog searches.
+    The footprint bounds are kept in an R-tree, the scene attributes and footprints in
+    SQLite (keyed by the R-tree ids), so lookups only load the candidate scenes.
+    Args:
+        path: Path of the index files without extension, creates {path}.sqlite and
+            the R-tree files {path}.idx and {path}.dat.
+    """
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_SCENE_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path.with_suffix(".sqlite")))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS scenes ("
+            "rowid INTEGER PRIMARY KEY, id TEXT, scene_id TEXT UNIQUE NOT NULL, "
+            "sensor TEXT, acquired TEXT, cloud_cover REAL, incidence_angle REAL, "
+            "block_names TEXT, minx REAL, miny REAL, maxx REAL, maxy REAL, "
+            "geometry BLOB)"
+        )
+        self.connection.commit()
+        self.rtree = rtree.index.Index(str(self.path))
+        # The R-tree is rebuilt from SQLite if an interrupted write left it behind.
+        if len(self.rtree) != len(self):
+            self.rebuild()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM scenes").fetchone()[0]
+
+    def rebuild(self):
+        """Rebuilds the R-tree from the footprints in SQLite by bulk loading."""
+        self.rtree.close()
+        properties = rtree.index.Property(overwrite=True)
+        rows = self.connection.execute(
+            "SELECT rowid, minx, miny, maxx, maxy FROM scenes"
+        )
+        stream = ((rowid, tuple(bounds), None) for rowid, *bounds in rows)
+        if len(self):
+            self.rtree = rtree.index.Index(
+                str(self.path), stream, properties=properties
+            )
+        else:
+            self.rtree = rtree.index.Index(str(self.path), properties=properties)
+
+    @profiled
+    def add_scenes(self, scenes: "GDF", sensor: Optional[str] = None) -> int:
+        """
+        Adds the scenes of a catalog search to the index, scenes that are already
+        indexed are skipped.
+        Args:
+            scenes: Search results with footprint geometries, scene_id, id,
+                cloudCoverage, incidenceAngle and optionally acquisitionDate,
+                constellation and blockNames columns.
+            sensor: Sensor of all scenes as in the search parameters, e.g. "pleiades".
+                Otherwise the sensor is derived from the constellation column.
+        Returns:
+            Number of new scenes.
+        """
+        scenes = scenes.to_crs(epsg=4326)
+        n_added = 0
+        for _, row in scenes.iterrows():
+            if row.geometry is None or row.geometry.is_empty:
+                continue
+            block_names = row.get("blockNames")
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO scenes (id, scene_id, sensor, acquired, "
+                "cloud_cover, incidence_angle, block_names, minx, miny, maxx, maxy, "
+                "geometry) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    row.get("id"),
+                    row.get("scene_id", row.get("id")),
+                    sensor
+                    if sensor is not None
+                    else get_sensor(row.get("constellation")),
+                    to_isoformat(row.get("acquisitionDate")),
+                    to_float(row.get("cloudCoverage")),
+                    to_float(row.get("incidenceAngle")),
+                    json.dumps(list(block_names))
+                    if isinstance(block_names, (list, tuple))
+                    else block_names,
+                    *row.geometry.bounds,
+                    wkb.dumps(row.geometry),
+                ),
+            )
+            if cursor.rowcount == 1:
+                self.rtree.insert(cursor.lastrowid, row.geometry.bounds)
+                n_added += 1
+        self.connection.commit()
+        self.rtree.flush()
+        return n_added
+
+    # pylint: disable=too-many-arguments, too-many-locals
+    @profiled
+    def query(
+        self,
+        geometry: BaseGeometry,
+        sensors: Optional[Iterable[str]] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        max_cloudcover: Optional[float] = None,
+        max_incidence_angle: Optional[float] = None,
+    ) -> "GDF":
+        """
+        Gets the indexed scenes intersecting a geometry, without any API call.
+        Args:
+            geometry: Query geometry in EPSG:4326, e.g. the AOI.
+            sensors: Only scenes of these sensors, e.g. ["pleiades"].
+            start_date: Only scenes acquired on or after this date (ISO format).
+            end_date: Only scenes acquired on or before this date (ISO format).
+            max_cloudcover: Maximum cloud cover (%).
+            max_incidence_angle: Maximum incidence angle (degrees).
+        Returns:
+            The scenes in EPSG:4326 with the columns of SCENE_COLUMNS, compatible with
+            the search results used for optimizing the coverage.
+        """
+        filters: List[str] = []
+        parameters: list = []
+        if sensors is not None:
+            # Also matches scenes stored with the catalog constellation.
+            sensors = [
+                name
+                for sensor in sensors
+                for name in [sensor, *SENSOR_CONSTELLATIONS.get(sensor, [])]
+            ]
+            filters.append(f"sensor IN ({', '.join('?' * len(sensors))})")
+            parameters.extend(sensors)
+        if start_date is not None:
+            filters.append("acquired >= ?")
+            parameters.append(to_isoformat(start_date))
+        if end_date is not None:
+            # Includes all acquisitions on the end date.
+            filters.append("acquired < ?")
+            parameters.append(
+                (pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)).isoformat()
+            )
+        if max_cloudcover is not None:
+            filters.append("cloud_cover <= ?")
+            parameters.append(max_cloudcover)
+        if max_incidence_angle is not None:
+            filters.append("incidence_angle <= ?")
+            parameters.append(max_incidence_angle)
+
+        candidates = list(self.rtree.intersection(geometry.bounds))
+        prepared = prep(geometry)
+        rows: List[tuple] = []
+        for i in range(0, len(candidates), QUERY_CHUNK_SIZE):
+            chunk = candidates[i : i + QUERY_CHUNK_SIZE]
+            sql = (
+                "SELECT id, scene_id, sensor, acquired, cloud_cover, incidence_angle, "
+                "block_names, geometry FROM scenes "
+                f"WHERE rowid IN ({', '.join('?' * len(chunk))})"
+            )
+            for row in self.connection.execute(
+                " AND ".join([sql, *filters]), [*chunk, *parameters]
+            ):
+                footprint = wkb.loads(row[-1])
+                if prepared.intersects(footprint):
+                    rows.append((*row[:-1], footprint))
+
+        df = pd.DataFrame(rows, columns=[*SCENE_COLUMNS, "geometry"])
+        df["acquisitionDate"] = pd.to_datetime(df["acquisitionDate"])
+        return gpd.GeoDataFrame(df, geometry="geometry", crs="EPSG:4326")
+
+    def close(self):
+        self.connection.close()
+        self.rtree.close()
@@ -0,0 +1,132 @@
+import json
+from typing import List, Union, Iterable, TYPE_CHECKING
+from pathlib import Path
+
+import numpy as np
+
+from utils.lazy import lazy_import
+from utils.profiling import profiled
+
+gpd = lazy_import("geopandas")
+pd = lazy_import("pandas")
+
+if TYPE_CHECKING:
+    from geopandas import GeoDataFrame as GDF
+
+# Few distinct values per search, stored as categories.
+CATEGORICAL_COLUMNS = ["constellation", "collection", "providerName", "blockNames"]
+
+
+def get_provider_property(provider_properties: Iterable[dict], name: str) -> np.ndarray:
+    """
+    Extracts a numeric provider property of all scenes, NaN where it is missing.
+    """
+    return np.fromiter(
+        (
+            np.nan
+            if not isinstance(properties, dict) or properties.get(name) is None
+            else properties[name]
+            for properties in provider_properties
+        ),
+        dtype="float32",
+    )
+
+
+def write_raw_properties(records: List[dict], path: Union[str, Path]) -> np.ndarray:
+    """
+    Writes the raw properties of the scenes as JSON lines.
+    Args:
+        records: Raw properties per scene.
+        path: Output JSON lines file.
+    Returns:
+        Byte offset of each scene's line, see read_raw_properties.
+    """
+    lines = [
+        (json.dumps(record, default=str) + "\n").encode("utf-8") for record in records
+    ]
+    with open(path, "wb") as f:
+        f.writelines(lines)
+    return np.cumsum([0] + [len(line) for line in lines], dtype="int64")[:-1]
+
+
+def read_raw_properties(path: Union[str, Path], offsets: Iterable[int]) -> List[dict]:
+    """
+    Reads the raw properties of scenes on demand.
+    Args:
+        path: JSON lines file written by normalize_search_results.
+        offsets: The raw_offset values of the scenes.
+    Returns:
+        The raw properties of the scenes.
+    """
+    records = []
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(int(offset))
+            records.append(json.loads(f.readline()))
+    return records
+
+
+@profiled
+def normalize_search_results(
+    search_results: "GDF", raw_path: Union[str, Path]
+) -> "GDF":
+    """
+    Normalizes catalog search results into a compact, typed scene table that all
+    later steps use. Numeric properties are float32, acquisition dates datetime and
+    repeated strings categorical. The nested and unused raw properties are written
+    to raw_path and can be read on demand via the raw_offset column.
+    Args:
+        search_results: Search results of the catalog.
+        raw_path: JSON lines file for the raw properties.
+    Returns:
+        The scene table with the columns id, scene_id, cloudCoverage,
+        incidenceAngle, acquisitionDate and the categorical columns if available,
+        plus raw_offset.
+    """
+    search_results = search_results.reset_index(drop=True)
+    table = {
+        "id": search_results["id"].astype(str),
+        "scene_id": search_results["scene_id"].astype(str),
+        "cloudCoverage": search_results["cloudCoverage"].astype("float32"),
+    }
+    if "providerProperties" in search_results:
+        table["incidenceAngle"] = get_provider_property(
+            search_results["providerProperties"], "incidenceAngle"
+        )
+    elif "incidenceAngle" in search_results:
+        table["incidenceAngle"] = search_results["incidenceAngle"].astype("float32")
+    if "acquisitionDate" in search_results:
+        table["acquisitionDate"] = pd.to_datetime(
+            search_results["acquisitionDate"], utc=True
+        )
+    for column in CATEGORICAL_COLUMNS:
+        if column in search_results:
+            values = search_results[column]
+            if column == "blockNames":
+                # Same representation as the exported search results.
+                values = values.astype(str)
+            table[column] = values.astype("category")
+
+    table["raw_offset"] = write_raw_properties(
+        search_results.drop(columns=search_results.geometry.name).to_dict(
+            orient="records"
+        ),
+        raw_path,
+    )
+    return gpd.GeoDataFrame(
+        table, geometry=search_results.geometry.values, crs=search_results.crs
+    )
+
+
+def write_geojson(df: "GDF", filename: Union[str, Path]):
+    """
+    Writes a scene table as GeoJSON, categorical columns are written as strings.
+    """
+    categorical = [
+        column
+        for column, dtype in df.dtypes.items()
+        if isinstance(dtype, pd.CategoricalDtype)
+    ]
+    df.astype({column: str for column in categorical}).to_file(
+        driver="GeoJSON", filename=filename
+    )
@@ -0,0 +1,386 @@
+import os
+import math
+import sqlite3
+from typing import List, Union, Optional, Tuple, Iterable
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from rasterio.windows import Window
+from rasterio.errors import WindowError
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds, reproject
+from rasterio.transform import from_bounds
+from rasterio.enums import Resampling
+from affine import Affine
+
+from utils.mosaic import get_percentile_ranges
+from utils.parallel import map_bounded
+from utils.profiling import profiled
+
+# Half the circumference of the Web Mercator (EPSG:3857) world in meters.
+ORIGIN_SHIFT = math.pi * 6378137.0
+WEB_MERCATOR = "EPSG:3857"
+
+
+def tile_bounds(x: int, y: int, z: int) -> Tuple[float, float, float, float]:
+    """
+    Gets the Web Mercator bounds of an XYZ tile (origin top left).
+    Args:
+        x: Tile column.
+        y: Tile row.
+        z: Zoom level.
+    Returns:
+        Tile bounds (left, bottom, right, top) in EPSG:3857 meters.
+    """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    left = -ORIGIN_SHIFT + x * size
+    top = ORIGIN_SHIFT - y * size
+    return left, top - size, left + size, top
+
+
+def get_tiles(bounds: tuple, zooms: Iterable[int]) -> List[Tuple[int, int, int]]:
+    """
+    Gets all XYZ tiles covering Web Mercator bounds for a range of zoom levels.
+    Args:
+        bounds: Bounds (left, bottom, right, top) in EPSG:3857 meters.
+        zooms: Zoom levels.
+    Returns:
+        (z, x, y) tuples, ordered by zoom level, row and column.
+    """
+    left, bottom, right, top = bounds
+    tiles: List[Tuple[int, int, int]] = []
+    for z in zooms:
+        n_tiles = 2 ** z
+        size = 2 * ORIGIN_SHIFT / n_tiles
+
+        def to_index(value, n_tiles=n_tiles, size=size):
+            return min(max(int(math.floor(value / size)), 0), n_tiles - 1)
+
+        min_x = to_index(left + ORIGIN_SHIFT)
+        max_x = to_index(right + ORIGIN_SHIFT - size * 1e-9)
+        min_y = to_index(ORIGIN_SHIFT - top)
+        max_y = to_index(ORIGIN_SHIFT - bottom - size * 1e-9)
+        tiles.extend(
+            (z, x, y) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1)
+        )
+    return tiles
+
+
+def get_tile_ranges(
+    mosaic_path: Union[str, Path], percentiles: tuple = (2, 98), max_size: int = 1024
+) -> Optional[List[Tuple[float, float]]]:
+    """
+    Gets the contrast stretch of the RGB bands for all tiles from a decimated read of
+    the mosaic, so that neighbouring tiles are stretched identically.
+    Args:
+        mosaic_path: Mosaic path.
+        percentiles: Lower and upper percentile for the contrast stretch.
+        max_size: Maximum width/height of the decimated read.
+    Returns:
+        (low, high) per RGB band, None for 8-bit mosaics that are not stretched.
+    """
+    with rasterio.open(mosaic_path) as src:
+        if src.dtypes[0] == "uint8":
+            return None
+        scale = max(src.width / max_size, src.height / max_size, 1)
+        indexes = get_rgb_indexes(src.count)
+        data = src.read(
+            indexes=indexes,
+            out_shape=(
+                len(indexes),
+                max(1, int(src.height / scale)),
+                max(1, int(src.width / scale)),
+            ),
+            masked=True,
+            resampling=Resampling.nearest,
+        )
+    return [
+        band_range if band_range is not None else (0.0, 1.0)
+        for band_range in get_percentile_ranges(data, percentiles)
+    ]
+
+
+def get_rgb_indexes(count: int) -> List[int]:
+    """Band indexes rendered as RGB, the first band for single band mosaics."""
+    return [1, 2, 3] if count >= 3 else [1, 1, 1]
+
+
+def read_tile_source(
+    src: rasterio.DatasetReader, bounds: tuple, tile_size: int
+) -> Optional[Tuple[np.ma.MaskedArray, Affine]]:
+    """
+    Reads the part of the mosaic below a Web Mercator tile. The read is decimated to
+    about the tile resolution, so GDAL serves low zoom levels from the overviews.
+    Args:
+        src: Opened mosaic.
+        bounds: Tile bounds in EPSG:3857.
+        tile_size: Tile size in pixels.
+    Returns:
+        The masked RGB data and its transform, None if the tile is outside the mosaic.
+    """
+    src_bounds = transform_bounds(WEB_MERCATOR, src.crs, *bounds, densify_pts=21)
+    try:
+        window = (
+            windows.from_bounds(*src_bounds, transform=src.transform)
+            .round_offsets(op="floor")
+            .round_lengths(op="ceil")
+            .intersection(Window(0, 0, src.width, src.height))
+        )
+    except WindowError:
+        return None
+    if window.width < 1 or window.height < 1:
+        return None
+
+    tile_res = (src_bounds[2] - src_bounds[0]) / tile_size
+    scale = max(tile_res / src.res[0], 1)
+    out_height = max(1, int(round(window.height / scale)))
+    out_width = max(1, int(round(window.width / scale)))
+    indexes = get_rgb_indexes(src.count)
+    data = src.read(
+        indexes=indexes,
+        window=window,
+        out_shape=(len(indexes), out_height, out_width),
+        masked=True,
+        resampling=Resampling.nearest,
+    )
+    transform = windows.transform(window, src.transform) * Affine.scale(
+        window.width / out_width, window.height / out_height
+    )
+    return data, transform
+
+
+# pylint: disable=too-many-locals
+def render_tile(
+    tile: Tuple[int, int, int],
+    mosaic_path: Union[str, Path],
+    ranges: Optional[List[Tuple[float, float]]] = None,
+    tile_size: int = 256,
+) -> Optional[bytes]:
+    """
+    Renders a single XYZ tile of the mosaic as RGBA PNG. Runs in a worker process.
+    Args:
+        tile: (z, x, y) of the tile.
+        mosaic_path: Mosaic path.
+        ranges: Contrast stretch per RGB band, see get_tile_ranges.
+        tile_size: Tile size in pixels.
+    Returns:
+        The PNG bytes, None if the tile is entirely nodata.
+    """
+    z, x, y = tile
+    bounds = tile_bounds(x, y, z)
+    with rasterio.open(mosaic_path) as src:
+        source = read_tile_source(src, bounds, tile_size)
+        src_crs = src.crs
+    if source is None:
+        return None
+    data, src_transform = source
+    if np.ma.getmaskarray(data).all():
+        return None
+
+    dst_transform = from_bounds(*bounds, tile_size, tile_size)
+    rgb = np.zeros((3, tile_size, tile_size), dtype="float32")
+    alpha = np.zeros((tile_size, tile_size), dtype="uint8")
+    reproject(
+        data.filled(0).astype("float32"),
+        rgb,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=dst_transform,
+        dst_crs=WEB_MERCATOR,
+        resampling=Resampling.nearest,
+    )
+    reproject(
+        (~np.ma.getmaskarray(data).all(axis=0)).astype("uint8") * 255,
+        alpha,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=dst_transform,
+        dst_crs=WEB_MERCATOR,
+        resampling=Resampling.nearest,
+    )
+    if not alpha.any():
+        return None
+
+    if ranges is not None:
+        for i, (low, high) in enumerate(ranges):
+            rgb[i] = np.clip((rgb[i] - low) / max(high - low, 1e-9), 0, 1) * 255
+    rgba = np.concatenate([np.clip(rgb, 0, 255).astype("uint8"), alpha[None]])
+    rgba[:3, alpha == 0] = 0
+
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="PNG",
+            width=tile_size,
+            height=tile_size,
+            count=4,
+            dtype="uint8",
+        ) as dst:
+            dst.write(rgba)
+        return memfile.read()
+
+
+class XYZWriter:
+    """Writes tiles to a {z}/{x}/{y}.png directory tree."""
+
+    def __init__(self, out_path: Union[str, Path]):
+        self.out_path = Path(out_path)
+
+    def tile_path(self, tile: Tuple[int, int, int]) -> Path:
+        z, x, y = tile
+        return self.out_path / str(z) / str(x) / f"{y}.png"
+
+    def exists(self, tile: Tuple[int, int, int]) -> bool:
+        return self.tile_path(tile).exists()
+
+    def write(self, tile: Tuple[int, int, int], data: bytes):
+        path = self.tile_path(tile)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Rename the complete file into place so an interrupted export never leaves a
+        # truncated tile that a resumed export would skip.
+        tmp_path = path.with_suffix(".png.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        pass
+
+
+class MBTilesWriter:
+    """Writes tiles to an MBTiles sqlite file (TMS row order)."""
+
+    def __init__(self, out_path: Union[str, Path], metadata: dict):
+        self.connection = sqlite3.connect(str(out_path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, "
+            "tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+        )
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+            "ON tiles (zoom_level, tile_column, tile_row)"
+        )
+        self.connection.execute("DELETE FROM metadata")
+        self.connection.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?)",
+            [(name, str(value)) for name, value in metadata.items()],
+        )
+        self.connection.commit()
+        self.existing = {
+            (z, x, 2 ** z - 1 - row)
+            for z, x, row in self.connection.execute(
+                "SELECT zoom_level, tile_column, tile_row FROM tiles"
+            )
+        }
+        self.pending = 0
+
+    def exists(self, tile: Tuple[int, int, int]) -> bool:
+        return tile in self.existing
+
+    def write(self, tile: Tuple[int, int, int], data: bytes):
+        z, x, y = tile
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tiles "
+            "(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+            (z, x, 2 ** z - 1 - y, sqlite3.Binary(data)),
+        )
+        self.pending += 1
+        # Commit in batches, a resumed export continues from the last batch.
+        if self.pending >= 256:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+# pylint: disable=too-many-locals
+@profiled
+def export_tiles(
+    mosaic_path: Union[str, Path],
+    out_path: Union[str, Path],
+    zooms: Tuple[int, int],
+    n_workers: Optional[int] = None,
+    tile_size: int = 256,
+    resume: bool = True,
+) -> dict:
+    """
+    Exports the mosaic as a Web Mercator tile pyramid for web maps. Tiles are rendered
+    in parallel worker processes and written by the main process, tiles that are
+    entirely nodata are not written. Exports to an MBTiles file if out_path ends with
+    ".mbtiles", otherwise to a {z}/{x}/{y}.png directory.
+    Args:
+        mosaic_path: Mosaic path, ideally with overviews for the low zoom levels.
+        out_path: Output MBTiles file or tile directory.
+        zooms: Minimum and maximum zoom level (inclusive).
+        n_workers: Number of worker processes, defaults to the number of CPUs.
+        tile_size: Tile size in pixels.
+        resume: Skip tiles that already exist in the output, e.g. from an
+            interrupted export.
+    Returns:
+        Number of "written", "existing" and "empty" (nodata) tiles.
+    """
+    min_zoom, max_zoom = zooms
+    with rasterio.open(mosaic_path) as src:
+        bounds = transform_bounds(src.crs, WEB_MERCATOR, *src.bounds, densify_pts=21)
+        lonlat_bounds = transform_bounds(
+            src.crs, "EPSG:4326", *src.bounds, densify_pts=21
+        )
+    tiles = get_tiles(bounds, range(min_zoom, max_zoom + 1))
+
+    writer: Union[XYZWriter, MBTilesWriter]
+    if str(out_path).endswith(".mbtiles"):
+        if not resume and Path(out_path).exists():
+            Path(out_path).unlink()
+        writer = MBTilesWriter(
+            out_path,
+            metadata={
+                "name": Path(mosaic_path).stem,
+                "format": "png",
+                "type": "overlay",
+                "minzoom": min_zoom,
+                "maxzoom": max_zoom,
+                "bounds": ",".join(f"{value:.6f}" for value in lonlat_bounds),
+            },
+        )
+    else:
+        writer = XYZWriter(out_path)
+
+    stats = {"written": 0, "existing": 0, "empty": 0}
+    if resume:
+        todo = [tile for tile in tiles if not writer.exists(tile)]
+        stats["existing"] = len(tiles) - len(todo)
+    else:
+        todo = tiles
+
+    ranges = get_tile_ranges(mosaic_path)
+    render = partial(
+        render_tile, mosaic_path=str(mosaic_path), ranges=ranges, tile_size=tile_size
+    )
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            chunksize = max(1, len(todo) // (4 * (n_workers or os.cpu_count() or 1)))
+            for tile, data in zip(
+                todo,
+                map_bounded(
+                    executor,
+                    render,
+                    todo,
+                    n_workers=n_workers,
+                    chunksize=min(chunksize, 64),
+                ),
+            ):
+                if data is None:
+                    stats["empty"] += 1
+                    continue
+                writer.write(tile, data)
+                stats["written"] += 1
+    finally:
+        writer.close()
+    return stats
@@ -1,25 +1,92 @@
+import os
+from typing import Optional
 from pathlib import Path
+from functools import lru_cache
+
+from utils.lazy import lazy_import
+from utils.geo import (
+    buffer_meter,
+    get_best_sections_full_coverage,
+    get_best_sections_per_feature,
+    clip_to_aoi,
+    coverage_percentage,
+    get_utm_zone_epsg,
+    WeightedScore,
+)
+from utils.scenes import normalize_search_results, write_geojson
+from utils.profiling import (
+    record_stage,
+    format_stage,
+    write_stage,
+    set_records_path,
+    get_records_path,
+)
+
+# The notebook, API and raster dependencies are only loaded when a step needs them.
+widgets = lazy_import("ipywidgets")
+ipyfilechooser = lazy_import("ipyfilechooser")
+IPython = lazy_import("IPython")
+pd = lazy_import("pandas")
+gpd = lazy_import("geopandas")
+up42 = lazy_import("up42")
+mosaic = lazy_import("utils.mosaic")
+coverage = lazy_import("utils.coverage")
+tiles = lazy_import("utils.tiles")
+scene_index = lazy_import("utils.scene_index")
+
+
+def display(*objs):
+    IPython.display.display(*objs)
+
+
+def print_mosaic_update(n_tiles: Optional[int]):
+    if n_tiles is None:
+        print("Created the full mosaic.")
+    else:
+        print(f"Updated {n_tiles} tiles of the existing mosaic.")
+
+
+def print_cog_stats(cog_stats: dict):
+    if not cog_stats["rewritten"]:
+        print(
+            f"COG ({cog_stats['codec']}): {cog_stats['size_mb']:.1f} MB, unchanged "
+            "(no tiles changed), not rewritten."
+        )
+        return
+    # COGs can not be edited in place, so any change rewrites the whole file.
+    print(
+        f"COG ({cog_stats['codec']}): {cog_stats['size_mb']:.1f} MB, rewritten "
+        f"completely from the working copy in {cog_stats['seconds']:.1f} s "
+        f"({cog_stats['throughput_mb_s']:.1f} MB/s uncompressed)"
+    )
+
+
+def print_unmatched_sections(unmatched_paths: list, unmatched_sections):
+    if unmatched_paths:
+        print(
+            f"WARNING: {len(unmatched_paths)} rasters match no optimized section and "
+            f"are left out of the mosaic: {[str(fp) for fp in unmatched_paths]}"
+        )
+    if not unmatched_sections.empty:
+        print(
+            f"WARNING: {len(unmatched_sections)} optimized sections have no raster, "
+            "the mosaic has gaps there:"
+        )
+        display(unmatched_sections)
 
-from ipyfilechooser import FileChooser
-from ipywidgets import widgets
-from IPython.display import display
-
-import matplotlib.pyplot as plt
-import pandas as pd
-import geopandas as gpd
-import rasterio
-from rasterio.merge import merge
-from rasterio.plot import show
-from rasterio.enums import ColorInterp
-
-import up42
 
-from utils.geo import buffer_meter, get_best_sections_full_coverage, coverage_percentage
+@lru_cache(maxsize=None)
+def get_directory_chooser() -> type:
+    """
+    FileChooser for directories, the class is created on first use as ipyfilechooser
+    is imported lazily.
+    """
+    # To rename filename to directory
+    # pylint: disable=too-many-ancestors
+    class DirectoryChooser(ipyfilechooser.FileChooser):  # type: ignore
+        _LBL_NOFILE = "No directory selected"
 
-# To rename filename to directory
-# pylint: disable=too-many-ancestors
-class DirectoryChooser(FileChooser):
-    _LBL_NOFILE = "No directory selected"
+    return DirectoryChooser
 
 
 class UI:
@@ -30,6 +97,7 @@ class UI:
         self.aoi = None
         self.sensors = None
         self.search_parameters = None
+        self.search_filters = None
         self.search_results = None
         self.catalog = None
         self.search_results_df = None
@@ -50,7 +118,15 @@ class UI:
         def on_button_click(button):
             with out:
                 out.clear_output()
-                on_button_click_process(**kwargs)
+                # Records the time, memory and API calls of the step.
+                stage = None
+                try:
+                    with record_stage(on_button_click_process.__name__) as stage:
+                        on_button_click_process(**kwargs)
+                finally:
+                    print(format_stage(stage))
+                    if get_records_path() is not None:
+                        write_stage(stage, get_records_path())
 
         button.on_click(on_button_click)
         display(*widget_list, button, out)
@@ -89,7 +165,7 @@ class UI:
         )
 
     def choose_output_folder(self):
-        fc = DirectoryChooser(filename="my_new_folder", select_default=True)
+        fc = get_directory_chooser()(filename="my_new_folder", select_default=True)
 
         fc.title = "<b>Select an output directory</b>"
         button = widgets.Button(description="Save!")
@@ -100,12 +176,13 @@ class UI:
             outdir.mkdir(parents=True, exist_ok=True)
             assert outdir.is_dir(), "Please select a directory, not a file."
             self.outdir = outdir
+            set_records_path(outdir / "profiling.jsonl")
             print(f"Saved {self.outdir}")
 
         self.process_template([fc], button, save_dir, fc=fc)
 
     def load_aoi(self):
-        fc = FileChooser(".")
+        fc = ipyfilechooser.FileChooser(".")
         fc.title = "<b>Select an input geometry file</b>"
 
         button = widgets.Button(description="Load!")
@@ -168,6 +245,12 @@ class UI:
             display(search_parameters)
             self.search_parameters = search_parameters
             self.sensors = sensors.value
+            self.search_filters = {
+                "sensors": [sensors.value],
+                "start_date": start_date.value,
+                "end_date": end_date.value,
+                "max_cloudcover": max_cloudcover.value,
+            }
 
         self.process_template(
             [start_date, end_date, sensors, max_cloudcover, limit],
@@ -180,6 +263,63 @@ class UI:
             limit=limit,
         )
 
+    def prescreen_aoi(self):
+        use_index = widgets.Checkbox(
+            value=False,
+            description="Optimize with the indexed scenes (skip the catalog search)",
+            indent=False,
+            layout={"width": "max-content"},
+        )
+        button = widgets.Button(description="Prescreen AOI!")
+
+        def prescreen_aoi(use_index):
+            assert self.ensure_variables(
+                (self.aoi, True)
+            ), "Please run steps before (select AOI)!"
+
+            # Scenes of previous searches, no API calls.
+            index = scene_index.SceneIndex()
+            scenes = index.query(
+                self.aoi.to_crs(epsg=4326).geometry.unary_union,
+                **(self.search_filters or {}),
+            )
+            index.close()
+            print(f"{len(scenes)} indexed scenes intersect the AOI.")
+            if scenes.empty:
+                return
+
+            try:
+                full_coverage = get_best_sections_full_coverage(
+                    df=clip_to_aoi(
+                        scenes, self.aoi.to_crs(epsg=4326).geometry.unary_union
+                    ),
+                    order_by=["cloudCoverage"],
+                )
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Could not pre-optimize the coverage: {e}")
+                return
+            cov = coverage_percentage(self.aoi, full_coverage)
+            print(
+                f"Estimated coverage with {len(full_coverage)} sections of indexed "
+                f"scenes: {round(cov)} %"
+            )
+
+            if use_index.value:
+                df = scenes[
+                    [
+                        "geometry",
+                        "id",
+                        "scene_id",
+                        "cloudCoverage",
+                        "blockNames",
+                        "incidenceAngle",
+                    ]
+                ].copy()
+                df["blockNames"] = df["blockNames"].astype(str)
+                self.search_results_df = df
+
+        self.process_template([use_index], button, prescreen_aoi, use_index=use_index)
+
     def search_available_images(self):
         out_file = widgets.Checkbox(
             value=False,
@@ -200,31 +340,37 @@ class UI:
             assert (
                 not search_results.empty
             ), "No results found! Try other search parameters."
-            search_results["incidenceAngle"] = search_results[
-                "providerProperties"
-            ].apply(lambda x: x["incidenceAngle"])
-            display(search_results)
-            self.catalog.plot_coverage(scenes=search_results, aoi=self.aoi)
-
-            # Reduce columns & export
-            df = search_results[
-                [
-                    "geometry",
-                    "id",
-                    "scene_id",
-                    "cloudCoverage",
-                    "blockNames",
-                    "incidenceAngle",
-                ]
-            ].copy()
-            df["blockNames"] = df["blockNames"].astype(str)
+            # Typed scene table for all later steps, the nested raw properties are
+            # only kept on disk.
+            scenes = normalize_search_results(
+                search_results, self.outdir / "search_results_properties.jsonl"
+            )
+            del search_results
+            display(scenes)
+            self.catalog.plot_coverage(scenes=scenes, aoi=self.aoi)
+
             if out_file.value:
-                df.to_file(
-                    driver="GeoJSON",
-                    filename=self.outdir / "search_results_limited_columns.geojson",
+                write_geojson(
+                    scenes[
+                        [
+                            "geometry",
+                            "id",
+                            "scene_id",
+                            "cloudCoverage",
+                            "blockNames",
+                            "incidenceAngle",
+                        ]
+                    ],
+                    self.outdir / "search_results_limited_columns.geojson",
                 )
-            self.search_results = search_results
-            self.search_results_df = df
+            self.search_results = scenes
+            self.search_results_df = scenes
+
+            # Remember the scenes for prescreening future AOIs offline.
+            index = scene_index.SceneIndex()
+            n_new = index.add_scenes(scenes, sensor=self.sensors)
+            print(f"Added {n_new} new scenes to the scene index ({len(index)} scenes).")
+            index.close()
 
         self.process_template([out_file], button, search_catalog)
 
@@ -274,18 +420,37 @@ class UI:
             description="Overlap between scenes (m)",
             style={"description_width": "initial"},
         )
+        aoi_features = widgets.RadioButtons(
+            options=["Union", "Separately"],
+            value="Union",
+            description="Optimize AOI features",
+            style={"description_width": "initial"},
+        )
+        ranking = widgets.RadioButtons(
+            options=["Cloud cover", "Weighted score"],
+            value="Cloud cover",
+            description="Rank scenes by",
+            style={"description_width": "initial"},
+        )
         button = widgets.Button(description="Optimize coverage!")
 
-        def optimize_coverage(max_incidence_angle, min_size_section_sqkm, buffer_size):
+        # pylint: disable=too-many-arguments
+        def optimize_coverage(
+            max_incidence_angle,
+            min_size_section_sqkm,
+            buffer_size,
+            aoi_features,
+            ranking,
+        ):
             assert self.ensure_variables(
                 (self.search_results_df, self.aoi)
             ), "Please run steps before (select AOI and search)!"
 
-            # Clip to aoi
-            clipped = gpd.clip(self.search_results_df, self.aoi.iloc[0].geometry)
-            clipped.geometry = clipped.geometry.buffer(0)
+            # Clip to the union of all aoi features
+            aoi_geometry = self.aoi.to_crs(epsg=4326).geometry.unary_union
+            clipped = clip_to_aoi(self.search_results_df, aoi_geometry)
 
-            clipped.to_file(driver="GeoJSON", filename=self.outdir / "clipped.geojson")
+            write_geojson(clipped, self.outdir / "clipped.geojson")
             self.clipped = clipped
 
             # Iteratively selected the next best scene and add to Dataframe.
@@ -300,15 +465,37 @@ class UI:
                 clipped_filtered_angle.incidenceAngle < max_incidence_angle.value
             ]
 
-            full_coverage = get_best_sections_full_coverage(
-                df=clipped_filtered_angle,
-                order_by=["cloudCoverage"],
-                min_size_section_sqkm=min_size_section_sqkm.value,
+            # The weighted score balances cloud cover, incidence angle, recency
+            # and the remaining area of the scenes, see WeightedScore. Ranking by
+            # cloud cover is the original behaviour.
+            ranking_kwargs = (
+                {"score": WeightedScore(max_incidence_angle=max_incidence_angle.value)}
+                if ranking.value == "Weighted score"
+                else {"order_by": ["cloudCoverage"]}
             )
+            if aoi_features.value == "Separately" and len(self.aoi) > 1:
+                full_coverage = get_best_sections_per_feature(
+                    clipped_filtered_angle,
+                    self.aoi,
+                    min_size_section_sqkm=min_size_section_sqkm.value,
+                    **ranking_kwargs,
+                )
+                skipped = sorted(
+                    set(range(len(self.aoi))) - set(full_coverage.aoi_feature)
+                )
+                if skipped:
+                    print(
+                        f"WARNING: AOI features {skipped} have no large enough sections "
+                        "and are not covered."
+                    )
+            else:
+                full_coverage = get_best_sections_full_coverage(
+                    df=clipped_filtered_angle,
+                    min_size_section_sqkm=min_size_section_sqkm.value,
+                    **ranking_kwargs,
+                )
             n_scenes = full_coverage.shape[0]
-            full_coverage.to_file(
-                driver="GeoJSON", filename=self.outdir / "full_coverage.geojson"
-            )
+            write_geojson(full_coverage, self.outdir / "full_coverage.geojson")
 
             # Buffer all sections by 10m (=5 Pixel 2m), so we ensure that all
             # sections overlap later on (no segment line breaks).
@@ -320,12 +507,11 @@ class UI:
                     distance=buffer_size.value,
                     epsg_in=4326,
                     use_centroid=False,
-                    lon=self.aoi.geometry.iloc[0].centroid.x,
-                    lat=self.aoi.geometry.iloc[0].centroid.y,
+                    lon=aoi_geometry.centroid.x,
+                    lat=aoi_geometry.centroid.y,
                 )
             )
-            full_coverage = gpd.clip(full_coverage, self.aoi.iloc[0].geometry)
-            full_coverage.geometry = full_coverage.geometry.buffer(0)
+            full_coverage = clip_to_aoi(full_coverage, aoi_geometry)
 
             display(full_coverage)
             up42.plot_coverage(full_coverage, aoi=self.aoi, figsize=(7, 7))
@@ -334,10 +520,7 @@ class UI:
             assert (
                 n_scenes == full_coverage.shape[0]
             ), "Something went wrong, a scene was dropped..."
-            full_coverage.to_file(
-                driver="GeoJSON",
-                filename=self.outdir / "full_coverage_buffered.geojson",
-            )
+            write_geojson(full_coverage, self.outdir / "full_coverage_buffered.geojson")
             print("=======================================================")
             print("Coverage of AOI is:")
             cov = coverage_percentage(self.aoi, full_coverage)
@@ -351,12 +534,20 @@ class UI:
             self.full_coverage = full_coverage
 
         self.process_template(
-            [max_incidence_angle, min_size_section_sqkm, buffer_size],
+            [
+                max_incidence_angle,
+                min_size_section_sqkm,
+                buffer_size,
+                aoi_features,
+                ranking,
+            ],
             button,
             optimize_coverage,
             max_incidence_angle=max_incidence_angle,
             min_size_section_sqkm=min_size_section_sqkm,
             buffer_size=buffer_size,
+            aoi_features=aoi_features,
+            ranking=ranking,
         )
 
     def test_workflow(self):
@@ -485,56 +676,228 @@ class UI:
 
         self.process_template([], button, run_workflow)
 
+    def verify_coverage(self):
+        n_workers = widgets.IntSlider(
+            value=os.cpu_count() or 1,
+            min=1,
+            max=max(os.cpu_count() or 1, 8),
+            step=1,
+            description="Worker processes",
+            style={"description_width": "initial"},
+        )
+        button = widgets.Button(description="Verify delivered coverage!")
+
+        def verify_delivered_coverage(n_workers):
+            assert self.ensure_variables(
+                (self.aoi, self.outdir)
+            ), "Please run steps before (load AOI and select outdir)!"
+
+            job_results = list(self.outdir.joinpath("sections").glob("*.tif"))
+            assert job_results, "Please run steps before (run jobs)!"
+
+            # Checks the valid pixels of the downloaded sections, not the plan.
+            cov, gaps, _ = coverage.verify_coverage(
+                self.aoi, job_results, n_workers=n_workers.value
+            )
+            print("=======================================================")
+            print("Delivered coverage of AOI is:")
+            print(f"{round(cov, 1)} %")
+            # Gaps of a previous verification, e.g. before re-running jobs.
+            gaps_path = self.outdir / "coverage_gaps.geojson"
+            gaps_path.unlink(missing_ok=True)
+            if not gaps.empty:
+                gaps.to_file(driver="GeoJSON", filename=gaps_path)
+                print(
+                    f"WARNING: {len(gaps)} gaps ({gaps.area_sqkm.sum():.3f} sqkm)! "
+                    "Check coverage_gaps.geojson"
+                )
+            print("=======================================================")
+
+        self.process_template(
+            [n_workers], button, verify_delivered_coverage, n_workers=n_workers
+        )
+
     def mosaic_sections(self):
+        mode = widgets.RadioButtons(
+            options=["COG", "GeoTIFF", "VRT"],
+            value="COG",
+            description="Mosaic format",
+            style={"description_width": "initial"},
+        )
+        codec = widgets.Dropdown(
+            options=mosaic.COG_CODECS,
+            value="DEFLATE",
+            description="COG compression (JPEG/WEBP only for 8 bit RGB)",
+            style={"description_width": "initial"},
+        )
+        n_workers = widgets.IntSlider(
+            value=os.cpu_count() or 1,
+            min=1,
+            max=max(os.cpu_count() or 1, 8),
+            step=1,
+            description="Worker processes",
+            style={"description_width": "initial"},
+        )
+        use_sections = widgets.Checkbox(
+            value=True,
+            description="Composite by optimized sections (full_coverage_buffered.geojson)",
+            indent=False,
+            layout={"width": "max-content"},
+        )
+        feather = widgets.Checkbox(
+            value=True,
+            description="Feather seams in the section overlaps",
+            indent=False,
+            layout={"width": "max-content"},
+        )
+        harmonize = widgets.Checkbox(
+            value=False,
+            description="Warp sections onto a common UTM grid (different sensors, blocks or UTM zones)",
+            indent=False,
+            layout={"width": "max-content"},
+        )
+        resolution = widgets.FloatText(
+            value=0,
+            description="Grid resolution (m), 0 for the finest section resolution",
+            style={"description_width": "initial"},
+        )
         button = widgets.Button(description="Create mosaic!")
 
-        def mosaic_sections():
+        def update_options(_=None):
+            # VRT mosaics reference the full sections, without compositing.
+            codec.disabled = mode.value != "COG"
+            feather.disabled = mode.value == "VRT"
+
+        mode.observe(update_options, names="value")
+        update_options()
+
+        # pylint: disable=too-many-arguments, too-many-locals
+        def mosaic_sections(
+            mode, codec, n_workers, use_sections, feather, harmonize, resolution
+        ):
             assert self.ensure_variables(
                 (self.outdir, True)
             ), "Please run steps before (select outdir)!"
+            assert not (
+                mode.value == "VRT" and harmonize.value
+            ), "VRT mosaics can not warp sections, use the COG or GeoTIFF format!"
 
             job_results = list(self.outdir.joinpath("sections").glob("*.tif"))
             display(job_results)
 
-            src_files_to_mosaic = []
-            for fp in job_results:
-                src = rasterio.open(fp)
-                src_files_to_mosaic.append(src)
-
-                out_profile = src.profile.copy()  # bzw. src.meta
-            display(src_files_to_mosaic)
-
-            mosaic, out_transform = merge(src_files_to_mosaic)
-            display(mosaic.shape)
-
-            out_profile.update(
-                {
-                    "height": mosaic.shape[1],
-                    "width": mosaic.shape[2],
-                    "transform": out_transform,
-                    "blockxsize": 256,
-                    "blockysize": 256,
-                    "tiled": True,  # Important for definition block structure!
-                }
-            )
+            # Stack the sections in the optimizer priority order, each only
+            # contributes the pixels within its section geometry.
+            cutlines = None
+            sections_file = self.outdir / "full_coverage_buffered.geojson"
+            if use_sections.value and sections_file.is_file():
+                (
+                    sections,
+                    unmatched_paths,
+                    unmatched_sections,
+                ) = mosaic.match_section_files(
+                    gpd.read_file(sections_file), job_results
+                )
+                display(sections)
+                print_unmatched_sections(unmatched_paths, unmatched_sections)
+                job_results = sections["path"].tolist()
+                cutlines = sections.geometry
+
+            # Sections are warped window by window while compositing.
+            grid = None
+            if harmonize.value:
+                assert self.ensure_variables(
+                    (self.aoi, True)
+                ), "Please select an AOI to warp onto its UTM grid!"
+                centroid = self.aoi.to_crs(epsg=4326).geometry.unary_union.centroid
+                grid = mosaic.get_target_grid(
+                    job_results,
+                    get_utm_zone_epsg(lon=centroid.x, lat=centroid.y),
+                    res=resolution.value or None,
+                )
+                print(
+                    f"Warping sections onto {grid['crs']}, {grid['res']} m grid "
+                    f"({grid['resampling'].name} resampling)."
+                )
 
             out_path_folder = self.outdir / "mosaic"
             out_path_folder.mkdir(parents=True, exist_ok=True)
-            # Write raster.
-            out_path = out_path_folder / "mosaic.tif"
-            with rasterio.open(out_path, "w", **out_profile) as dst:
-                for i in range(mosaic.shape[0]):
-                    dst.write(mosaic[i, ...], i + 1)
-                dst.colorinterp = [
-                    ColorInterp.red,
-                    ColorInterp.green,
-                    ColorInterp.blue,
-                    ColorInterp.undefined,
-                ]
+            if mode.value == "VRT":
+                if cutlines is not None:
+                    print(
+                        "VRT mosaics use the full sections in the order of the "
+                        "optimization, without cutlines or feathering."
+                    )
+                # Only references the sections, materialize later if required.
+                out_path = mosaic.build_vrt(job_results, out_path_folder / "mosaic.vrt")
+            elif mode.value == "GeoTIFF":
+                out_path = out_path_folder / "mosaic.tif"
+                # Only recomposite the tiles of changed sections, if possible.
+                n_tiles = mosaic.update_or_create_mosaic(
+                    out_path,
+                    job_results,
+                    n_workers=n_workers.value,
+                    cutlines=cutlines,
+                    feather=feather.value,
+                    grid=grid,
+                )
+                print_mosaic_update(n_tiles)
+            else:
+                # Composite tile windows in parallel into the working copy (only
+                # changed tiles if possible), then compress and add overviews in
+                # one pass.
+                cog_stats = mosaic.mosaic_cog(
+                    job_results,
+                    out_path_folder / "mosaic.tif",
+                    codec.value,
+                    n_workers=n_workers.value,
+                    cutlines=cutlines,
+                    feather=feather.value,
+                    grid=grid,
+                )
+                out_path = cog_stats["path"]
+                print_mosaic_update(cog_stats["updated_tiles"])
+                print_cog_stats(cog_stats)
+            self.out_path = out_path
+            print("DONE!")
+
+        self.process_template(
+            [mode, codec, n_workers, use_sections, feather, harmonize, resolution],
+            button,
+            mosaic_sections,
+            mode=mode,
+            codec=codec,
+            n_workers=n_workers,
+            use_sections=use_sections,
+            feather=feather,
+            harmonize=harmonize,
+            resolution=resolution,
+        )
+
+    def materialize_mosaic(self):
+        bounds = widgets.Text(
+            description="Bounds (left, bottom, right, top), empty for full mosaic",
+            style={"description_width": "initial"},
+            layout={"width": "max-content"},
+        )
+        button = widgets.Button(description="Materialize mosaic!")
+
+        def materialize_mosaic(bounds):
+            assert self.ensure_variables(
+                (self.out_path, True)
+            ), "Please run steps before (mosaic sections)!"
+            assert self.out_path.suffix == ".vrt", "Mosaic is already a GeoTIFF!"
+
+            window_bounds = None
+            if bounds.value.strip():
+                window_bounds = tuple(float(b) for b in bounds.value.split(","))
+                assert len(window_bounds) == 4, "Please provide four bounds!"
+            out_path = mosaic.materialize_vrt(
+                self.out_path, self.out_path.with_suffix(".tif"), bounds=window_bounds
+            )
             self.out_path = out_path
             print("DONE!")
 
-        self.process_template([], button, mosaic_sections)
+        self.process_template([bounds], button, materialize_mosaic, bounds=bounds)
 
     def view_mosaic(self):
         button = widgets.Button(description="View mosaic!")
@@ -544,10 +907,68 @@ class UI:
                 (self.out_path, True)
             ), "Please run steps before (mosaic sections)!"
 
-            with rasterio.open(self.out_path) as src:
-                _, ax = plt.subplots(nrows=1, ncols=1, figsize=(12, 12))
+            # pylint: disable=import-outside-toplevel
+            import matplotlib.pyplot as plt
 
-                show(src, ax=ax)
-                plt.show()
+            figsize = 12
+            # Only read as many pixels as the figure can display.
+            preview, extent = mosaic.read_preview(
+                self.out_path, max_size=int(figsize * plt.rcParams["figure.dpi"])
+            )
+            _, ax = plt.subplots(nrows=1, ncols=1, figsize=(figsize, figsize))
+            ax.imshow(preview, extent=extent)
+            plt.show()
 
         self.process_template([], button, view_mosaic)
+
+    def export_tiles(self):
+        zooms = widgets.IntRangeSlider(
+            value=[10, 16],
+            min=0,
+            max=22,
+            step=1,
+            description="Zoom levels",
+            style={"description_width": "initial"},
+        )
+        tile_format = widgets.RadioButtons(
+            options=["XYZ", "MBTiles"],
+            value="XYZ",
+            description="Tile format",
+            style={"description_width": "initial"},
+        )
+        n_workers = widgets.IntSlider(
+            value=os.cpu_count() or 1,
+            min=1,
+            max=max(os.cpu_count() or 1, 8),
+            step=1,
+            description="Worker processes",
+            style={"description_width": "initial"},
+        )
+        button = widgets.Button(description="Export tiles!")
+
+        def export_mosaic_tiles(zooms, tile_format, n_workers):
+            assert self.ensure_variables(
+                (self.out_path, True)
+            ), "Please run steps before (mosaic sections)!"
+
+            if tile_format.value == "MBTiles":
+                out_path = self.out_path.with_suffix(".mbtiles")
+            else:
+                out_path = self.out_path.parent / "tiles"
+            stats = tiles.export_tiles(
+                self.out_path, out_path, zooms.value, n_workers=n_workers.value
+            )
+            print(
+                f"Wrote {stats['written']} tiles to {out_path}, skipped "
+                f"{stats['existing']} existing and {stats['empty']} empty tiles."
+            )
+            print("DONE!")
+
+        self.process_template(
+            [zooms, tile_format, n_workers],
+            button,
+            export_mosaic_tiles,
+            zooms=zooms,
+            tile_format=tile_format,
+            n_workers=n_workers,
+        )